@@ -0,0 +1,68 @@
+"""
+    Benchmark of parsers of file's parts: per-line parser against batch
+    one, extract_coord against extract_coord_batch for statistic of
+    locations and parse_main_part against parse_main_part_batch for
+    date and time of events.
+
+    Run from the repository root:
+        python -m benchmarks.bench_parsers statistics
+        python -m benchmarks.bench_parsers chronology 1000 100000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from draw import procloc
+from benchmarks import locgen
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+# Per-line parser is quadratic, so don't wait for it on huge partitions.
+ROWWISE_LIMIT = 10000
+
+# Generator of lines, per-line parser, batch parser and columns of
+# dataframe for every part of file.
+PARSERS = {
+    'statistics': (locgen.make_stat_lines, procloc.extract_coord,
+                   procloc.extract_coord_batch, procloc.LOC_COLUMNS),
+    'chronology': (locgen.make_dt_lines, procloc.parse_main_part,
+                   procloc.parse_main_part_batch, procloc.DT_COLUMNS),
+}
+
+
+def timeit(func, *args):
+    """Return the time of func(*args) call in seconds."""
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def run(part, sizes=SIZES):
+    """Print times of both parsers of <part> for every count of lines."""
+    make_lines, rowwise_parser, batch_parser, columns = PARSERS[part]
+    print(f"{'lines':>10} {'rowwise, s':>12} {'batch, s':>10} "
+          f"{'lines/s':>12}")
+    for size in sizes:
+        lines = make_lines(size)
+        if size <= ROWWISE_LIMIT:
+            empty = pd.DataFrame(columns=columns)
+            rowwise = f"{timeit(rowwise_parser, lines, empty):12.3f}"
+        else:
+            rowwise = f"{'-':>12}"
+        batch = timeit(batch_parser, lines)
+        print(f"{size:>10} {rowwise} {batch:10.3f} {size / batch:12.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('part', choices=sorted(PARSERS),
+                        help="Part of file whose parsers are compared.")
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES,
+                        help="Counts of lines.")
+    args = parser.parse_args(argv)
+    run(args.part, args.sizes)
+
+
+if __name__ == '__main__':
+    main()
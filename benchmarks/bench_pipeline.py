@@ -0,0 +1,200 @@
+"""
+    Benchmark suite of procloc pipeline on synthetic loc-files.
+    Files are processed by the real prepare_file and finish_file with
+    stub of mapnik, time of every stage is taken from metrics of task:
+    discovery, parse (with decode), group, project, render and report.
+    Peak memory of stage, the most for one file, is measured by
+    tracemalloc in a separate pass.
+
+    Run from the repository root:
+        python -m benchmarks.bench_pipeline --files 20 --dt-lines 50000 \\
+            --save results.json
+        python -m benchmarks.bench_pipeline --files 20 --dt-lines 50000 \\
+            --compare results.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from benchmarks import locgen, stub_mapnik
+
+# Rendering is measured without real mapnik.
+sys.modules['mapnik'] = stub_mapnik
+
+from draw import discovery, procloc, render, report  # noqa: E402
+from draw.metrics import TaskMetrics  # noqa: E402
+
+STAGES = ['discovery', 'parse', 'group', 'project', 'render', 'report']
+
+
+class MemoryMetrics(TaskMetrics):
+    """Metrics of task with peak memory allocated by every stage."""
+
+    def __init__(self):
+        super().__init__()
+        self.peaks = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name, file=None):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+            with super().stage(name, file):
+                yield
+        finally:
+            self.peaks[name] = max(self.peaks[name],
+                                   tracemalloc.get_traced_memory()[1] - base)
+
+
+def run_pipeline(path, metrics, style, script):
+    """Process all loc-files of directory <path> with <metrics>."""
+    with metrics.stage('discovery'):
+        files = [(file, kinds[discovery.LOC_SUFFIX].path)
+                 for file, kinds in discovery.discover(path).items()
+                 if discovery.LOC_SUFFIX in kinds]
+
+    with render.RenderStage(workers=0, cache_dir=None) as stage:
+        for file, filename in files:
+            summary, locations, outputs, jobs, _ = procloc.prepare_file(
+                path, file, filename, metrics, closeups=True)
+            # Without workers images are rendered when jobs are sent.
+            with metrics.stage('render'):
+                futures = [stage.submit(job) for job in jobs]
+            procloc.finish_file(path, file, summary, locations, outputs,
+                                jobs, futures, stage, metrics, style, script)
+
+
+def measure(path, memory, style, script):
+    """
+        Run pipeline once. Return {stage: seconds} or, if <memory>,
+        {stage: peak bytes allocated by stage}.
+    """
+    if not memory:
+        metrics = TaskMetrics()
+        run_pipeline(path, metrics, style, script)
+        return {stage: metrics.stages[stage] for stage in STAGES}
+
+    metrics = MemoryMetrics()
+    tracemalloc.start()
+    try:
+        run_pipeline(path, metrics, style, script)
+    finally:
+        tracemalloc.stop()
+    return {stage: metrics.peaks[stage] for stage in STAGES}
+
+
+def run(files, dt_lines, stat_lines, repeat, seed=0):
+    """Return results of benchmark with given sizes of input."""
+    with tempfile.TemporaryDirectory() as path:
+        lines = locgen.write_task_dir(path, files, dt_lines, stat_lines,
+                                      seed=seed)
+        # Empty static files of report, they are read once.
+        style = os.path.join(path, report.REPORT_STYLE)
+        script = os.path.join(path, report.REPORT_SCRIPT)
+        for name in (style, script):
+            open(name, 'w').close()
+
+        # The best of repeats is the least noisy time.
+        timings = [measure(path, False, style, script)
+                   for _ in range(repeat)]
+        peaks = measure(path, True, style, script)
+
+    results = {
+        'params': {
+            'files': files,
+            'dt_lines': dt_lines,
+            'stat_lines': stat_lines,
+            'seed': seed,
+        },
+        'stages': {},
+    }
+    for stage in STAGES:
+        seconds = min(timing[stage] for timing in timings)
+        results['stages'][stage] = {
+            'seconds': seconds,
+            'peak_bytes': peaks[stage],
+            'files_per_sec': files / seconds if seconds else None,
+            'lines_per_sec': lines / seconds if seconds else None,
+        }
+    total = sum(stage['seconds'] for stage in results['stages'].values())
+    results['total'] = {
+        'seconds': total,
+        'files_per_sec': files / total,
+        'lines_per_sec': lines / total,
+    }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+        Return list of messages about stages that are slower than in
+        <baseline> more than by part <threshold>.
+    """
+    if results['params'] != baseline['params']:
+        raise ValueError(f"Baseline was made with other params: "
+                         f"{baseline['params']}")
+    if set(baseline['stages']) != set(STAGES):
+        raise ValueError(f"Baseline was made with other stages: "
+                         f"{sorted(baseline['stages'])}")
+    regressions = []
+    for stage in STAGES:
+        old = baseline['stages'][stage]['seconds']
+        new = results['stages'][stage]['seconds']
+        if old and new > old * (1 + threshold):
+            regressions.append(f"{stage}: {old:.3f}s -> {new:.3f}s "
+                               f"(+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'stage':>10} {'seconds':>9} {'peak, MB':>9} "
+          f"{'files/s':>10} {'lines/s':>12}")
+    for stage in STAGES:
+        item = results['stages'][stage]
+        print(f"{stage:>10} {item['seconds']:9.3f} "
+              f"{item['peak_bytes'] / 1024**2:9.1f} "
+              f"{item['files_per_sec'] or 0:10.1f} "
+              f"{item['lines_per_sec'] or 0:12.0f}")
+    total = results['total']
+    print(f"{'total':>10} {total['seconds']:9.3f} {'':>9} "
+          f"{total['files_per_sec']:10.1f} {total['lines_per_sec']:12.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--dt-lines', type=int, default=10000,
+                        help="Lines with date and time in every file.")
+    parser.add_argument('--stat-lines', type=int, default=1000,
+                        help="Lines with statistic in every file.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help="Save results to JSON-file.")
+    parser.add_argument('--compare', help="JSON-file with baseline results.")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Allowed slowdown of stage, 0.2 is 20%%.")
+    args = parser.parse_args(argv)
+
+    results = run(args.files, args.dt_lines, args.stat_lines, args.repeat)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
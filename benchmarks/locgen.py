@@ -0,0 +1,72 @@
+"""Generator of synthetic loc-file content for benchmarks."""
+import os
+import random
+
+
+def make_address(n):
+    """Return a text description of address number n."""
+    return f"г. Москва, ул. Тестовая, д. {n} "
+
+
+def make_dms(n, direction):
+    """Return a coordinate in DMS like it is written in loc-files."""
+    return f"{50 + n % 10}d{n % 60}m{(n * 7) % 60}s{direction}"
+
+
+def make_stat_lines(count, seed=0):
+    """
+        Return a list of <count> lines of file's part with statistic
+        of locations.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for n in range(count):
+        lines.append(
+            f"{rnd.randrange(1, 1000)} ({rnd.random() * 10:.2f}%) - "
+            f"A{1000 + n % 5000}-{n:x} - {make_address(n)}"
+            f"({make_dms(n, 'N')}, {make_dms(n + 3, 'E')}, "
+            f"{rnd.randrange(360)} -\n")
+    return lines
+
+
+def make_dt_lines(count, addresses=100, seed=0):
+    """
+        Return a list of <count> lines of file's part with date and time
+        of events.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for n in range(count):
+        a = rnd.randrange(addresses)
+        lines.append(
+            f"{n % 28 + 1:02d}.01.2020 {n % 24:02d}:{n % 60:02d}:00"
+            f"\tIMSI={250010000000000 + n}\tLAC-CID=A{1000 + a}-{a:x}"
+            f"\t{make_address(a)}({make_dms(a, 'N')}, {make_dms(a + 3, 'E')})\n")
+    return lines
+
+
+def make_loc_lines(dt_count, stat_count, addresses=100, seed=0):
+    """
+        Return lines of loc-file: header, part with date and time of
+        events, summary and part with statistic of locations separated
+        by blank lines.
+    """
+    return (["Местоположения абонента\n"] +
+            make_dt_lines(dt_count, min(addresses, stat_count) or 1, seed) +
+            ["\n", f"Всего событий: {dt_count}\n", "\n"] +
+            make_stat_lines(stat_count, seed))
+
+
+def write_task_dir(path, files, dt_count, stat_count, addresses=100, seed=0):
+    """
+        Write <files> loc-files in windows-1251 to directory <path>
+        like it is done by billing. Return count of written lines.
+    """
+    lines_count = 0
+    for n in range(files):
+        lines = make_loc_lines(dt_count, stat_count, addresses, seed + n)
+        with open(os.path.join(path, f"7900{n:07d}loc"), 'w',
+                  encoding='windows-1251') as f:
+            f.writelines(lines)
+        lines_count += len(lines)
+    return lines_count
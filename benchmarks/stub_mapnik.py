@@ -0,0 +1,88 @@
+"""
+    Stub of mapnik bindings for benchmarks: the pipeline is measured
+    without the cost of real rendering, images are tiny files.
+"""
+
+
+class _Holder:
+    def __init__(self, *args):
+        self.rules = []
+        self.symbols = []
+        self.styles = []
+
+
+class Style(_Holder):
+    pass
+
+
+class Rule(_Holder):
+    pass
+
+
+class MarkersSymbolizer(_Holder):
+    pass
+
+
+class Expression(str):
+    pass
+
+
+class Context:
+    def push(self, name):
+        pass
+
+
+class Geometry:
+    @staticmethod
+    def from_wkt(wkt):
+        return wkt
+
+
+class Feature:
+    def __init__(self, context, id):
+        self.geometry = Geometry()
+        self.attributes = {}
+
+    def __setitem__(self, name, value):
+        self.attributes[name] = value
+
+
+class MemoryDatasource:
+    def __init__(self):
+        self.features = []
+
+    def add_feature(self, feature):
+        self.features.append(feature)
+
+
+class Layer:
+    def __init__(self, name):
+        self.name = name
+        self.styles = []
+        self.datasource = None
+
+
+class Box2d:
+    def __init__(self, *bounds):
+        self.bounds = bounds
+
+
+class Map:
+    def __init__(self, width, height):
+        self.layers = []
+        self.styles = {}
+
+    def append_style(self, name, style):
+        self.styles[name] = style
+
+    def zoom_to_box(self, box):
+        self.box = box
+
+
+def load_map(m, mapnik_xml):
+    pass
+
+
+def render_to_file(m, output, *args):
+    with open(output, 'wb') as f:
+        f.write(b'\x89PNG')
@@ -0,0 +1,63 @@
+"""Cached catalog of directories with tasks: year/depart/sz."""
+import os
+import threading
+import time
+
+PATH_TO_DIR = "/home/user/python_projects/"
+
+# Seconds during which listing of directory is used without any checks.
+CATALOG_TTL = 60
+
+
+class Catalog:
+    """
+        In-memory cache of subdirectories of year/depart/sz tree.
+        Listing of directory is read again only when TTL is over and
+        mtime of directory was changed.
+    """
+
+    def __init__(self, root=PATH_TO_DIR, ttl=CATALOG_TTL):
+        self.root = root
+        self.ttl = ttl
+        # Path of directory -> (mtime, time of check, names of subdirs).
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def subdirs(self, *parts):
+        """Return sorted names of subdirectories of root/<parts>."""
+        path = os.path.join(self.root, *parts)
+        now = time.monotonic()
+        with self._lock:
+            listing = self._listings.get(path)
+        if listing is not None and now - listing[1] < self.ttl:
+            return listing[2]
+
+        mtime = os.stat(path).st_mtime_ns
+        if listing is not None and listing[0] == mtime:
+            names = listing[2]
+        else:
+            # Type of entry is known from scandir without extra stat calls.
+            with os.scandir(path) as entries:
+                names = sorted(entry.name for entry in entries
+                               if entry.is_dir())
+        with self._lock:
+            self._listings[path] = (mtime, now, names)
+        return names
+
+    def years(self):
+        return self.subdirs()
+
+    def departments(self, year):
+        """Return departments of year, empty list for unknown year."""
+        if year not in self.years():
+            return []
+        return self.subdirs(year)
+
+    def sz(self, year, depart):
+        """Return sz of department, empty list for unknown department."""
+        if depart not in self.departments(year):
+            return []
+        return self.subdirs(year, depart)
+
+
+catalog = Catalog()
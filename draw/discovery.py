@@ -0,0 +1,75 @@
+"""Discovery of subscriber files in task directory."""
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Extensions of subscriber files.
+EXTENSIONS = ('.ext1', '.ext2', '.ext3')
+
+# Suffix of loc-file name, the rest of name is subscriber key.
+LOC_SUFFIX = 'loc'
+
+# Count of threads listing subdirectories at the same time.
+DISCOVERY_WORKERS = 8
+
+FileInfo = namedtuple('FileInfo', ['path', 'size', 'mtime'])
+
+
+def classify(name):
+    """
+        Return (key, kind) of subscriber file with name <name>,
+        kind is extension or 'loc'. Return None for other files.
+    """
+    stem, ext = os.path.splitext(name)
+    if ext in EXTENSIONS:
+        return stem, ext
+    if name.endswith(LOC_SUFFIX) and len(name) > len(LOC_SUFFIX):
+        return name[:-len(LOC_SUFFIX)], LOC_SUFFIX
+    return None
+
+
+def scan_dir(path):
+    """
+        List directory once. Return subscriber files as
+        [(key, kind, FileInfo), ...] and paths of subdirectories.
+    """
+    files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+                continue
+            key_kind = classify(entry.name)
+            if key_kind is not None and entry.is_file():
+                stat = entry.stat()
+                files.append((*key_kind, FileInfo(entry.path, stat.st_size,
+                                                  stat.st_mtime_ns)))
+    return files, subdirs
+
+
+def discover(path, workers=DISCOVERY_WORKERS):
+    """
+        Find subscriber files in directory tree <path>, subdirectories
+        are listed in parallel. Return index {key: {kind: FileInfo}}
+        sorted by key.
+    """
+    index = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_dir, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(
+                    executor.submit(scan_dir, subdir) for subdir in subdirs)
+                for key, kind, info in files:
+                    kinds = index.setdefault(key, {})
+                    if kind in kinds:
+                        logging.warning(f"Duplicate file {info.path}, "
+                                        f"{kinds[kind].path} is used.")
+                        if kinds[kind].path < info.path:
+                            continue
+                    kinds[kind] = info
+    return dict(sorted(index.items()))
@@ -1,16 +1,19 @@
-import os
 from django import forms
 
-PATH_TO_DIR = "/home/user/python_projects/"
+from .catalog import catalog
+
+
+def year_choices():
+    """Return choices of years, they are read only when form is created."""
+    return TaskForm.blank_choice + tuple(
+        (item, item) for item in catalog.years())
 
 
 class TaskForm(forms.Form):
     blank_choice = (('', '----Выберите значение----'), )
     # CHOICES = tuple((item, item) for item in os.listdir("/mnt/billing/")
     #                if os.path.isdir(os.path.join("/mnt/billing/", item)))
-    CHOICES = tuple((item, item) for item in os.listdir(PATH_TO_DIR)
-                    if os.path.isdir(os.path.join(PATH_TO_DIR, item)))
-    yearField = forms.ChoiceField(choices=blank_choice + CHOICES,
+    yearField = forms.ChoiceField(choices=year_choices,
                                   label="Выберите год:")
     departField = forms.ChoiceField(choices=blank_choice,
                                     label="Выберите подразделение:")
@@ -0,0 +1,155 @@
+"""Background worker processing queued tasks."""
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.urls import reverse
+from django.utils import timezone
+
+from draw import procloc
+from draw.catalog import PATH_TO_DIR
+from draw.models import MetricsTotal, Task
+
+# Task in processing without progress for this time is taken as lost.
+STALE_AFTER = 60 * 60
+
+
+def run_task(path, task_id, render_workers, file_workers):
+    """Process directory of task in worker process. Return its metrics."""
+
+    def progress(stage, done, total):
+        Task.set_progress(task_id, stage, done, total)
+
+    try:
+        return procloc.start(path, task_id, progress, workers=render_workers,
+                             file_workers=file_workers,
+                             marker_url=reverse('draw:marker'))
+    finally:
+        connections.close_all()
+
+
+def start_pool(workers):
+    """Return pool of processes for tasks, they set up Django themselves."""
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=django.setup)
+
+
+class Command(BaseCommand):
+    help = "Claim queued tasks and process them in a pool of processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2,
+                            help="Count of tasks processed concurrently.")
+        parser.add_argument('--render-workers', type=int, default=0,
+                            help="Count of render processes per task, "
+                            "0 - render in the task process.")
+        parser.add_argument('--file-workers', type=int,
+                            default=procloc.FILE_WORKERS,
+                            help="Count of processes processing files of "
+                            "one task, every one renders its maps itself.")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds between polls of the queue.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit when the queue is empty.")
+        parser.add_argument('--stale-after', type=float, default=STALE_AFTER,
+                            help="Seconds without progress after which "
+                            "task in processing is queued again.")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+
+        # Tasks of workers died during processing are taken again.
+        reclaimed = Task.reclaim_stale(options['stale_after'])
+        if reclaimed:
+            self.stdout.write(f"Queued again {reclaimed} stale tasks.")
+
+        # Worker processes must not share connections to database, so
+        # they are started clean and open their own connections.
+        connections.close_all()
+
+        running = {}
+        executor = start_pool(workers)
+        # Futures of the current pool, futures of a broken one fail too.
+        pooled = set()
+        try:
+            while True:
+                # To claim tasks while there are free workers.
+                while len(running) < workers:
+                    task = Task.claim_next()
+                    if task is None:
+                        break
+                    path = os.path.join(PATH_TO_DIR, task.year, task.depart,
+                                        task.sz)
+                    self.stdout.write(f"Start task {task.id}: {path}")
+                    connections.close_all()
+                    try:
+                        future = executor.submit(run_task, path, task.id,
+                                                 options['render_workers'],
+                                                 options['file_workers'])
+                    except BrokenProcessPool:
+                        # Some worker process died, so the task is taken
+                        # again by a new pool.
+                        Task.requeue(task.id)
+                        executor = self.restart_pool(executor, workers)
+                        pooled = set()
+                        continue
+                    running[future] = task
+                    pooled.add(future)
+
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                done, _ = wait(running, timeout=options['interval'],
+                               return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    task = running.pop(future)
+                    task.finished_at = timezone.now()
+                    task.stage = ''
+                    if future.exception() is None:
+                        task.status = Task.STATUS_DONE
+                        metrics = future.result()
+                        counters = metrics['counters']
+                        task.metrics = metrics
+                        task.duration = metrics['duration']
+                        task.files_processed = counters.get(
+                            'files_processed', 0)
+                        task.files_failed = counters.get('files_failed', 0)
+                        self.stdout.write(f"Finish task {task.id} in "
+                                          f"{task.duration:.1f} s.")
+                    else:
+                        # Task whose process died fails, the pool is
+                        # started again for the next tasks.
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            broken = broken or future in pooled
+                        task.status = Task.STATUS_FAILED
+                        task.error = repr(future.exception())
+                        self.stderr.write(f"Task {task.id} failed: "
+                                          f"{future.exception()!r}")
+                    task.save(update_fields=[
+                        'status', 'stage', 'finished_at', 'error', 'metrics',
+                        'duration', 'files_processed', 'files_failed'
+                    ])
+                    if task.status == Task.STATUS_DONE:
+                        MetricsTotal.add(task.metrics)
+                    pooled.discard(future)
+                if broken:
+                    executor = self.restart_pool(executor, workers)
+                    pooled = set()
+        finally:
+            executor.shutdown()
+
+    def restart_pool(self, executor, workers):
+        """Replace broken pool <executor> by a new one."""
+        self.stderr.write("Process of task died, pool is started again.")
+        executor.shutdown(wait=False)
+        return start_pool(workers)
@@ -0,0 +1,93 @@
+"""Manifest of processed files in task directory for incremental runs."""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+MANIFEST_NAME = '.procloc_manifest.json'
+
+# Change it when outputs of procloc become incompatible with old ones.
+MANIFEST_VERSION = 1
+
+FileStat = namedtuple('FileStat', ['size', 'mtime'])
+
+
+def file_hash(filename):
+    """Return sha1 hash of file content."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+        Size, mtime and content hash of every processed input file of
+        directory together with outputs produced from it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.join(path, MANIFEST_NAME)
+        self.files = {}
+        try:
+            with open(self.filename) as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return
+        if content.get('version') == MANIFEST_VERSION:
+            self.files = content['files']
+
+    def key(self, filename):
+        return os.path.relpath(filename, self.path)
+
+    def is_current(self, filename, stat=None, options=None):
+        """
+            Return True if file wasn't changed since it was processed
+            with the same <options> and all its outputs are still in
+            place. Size and mtime are taken from <stat> if it is known.
+        """
+        entry = self.files.get(self.key(filename))
+        if entry is None:
+            return False
+        if entry.get('options', {}) != (options or {}):
+            return False
+        if not all(os.path.exists(os.path.join(self.path, output))
+                   for output in entry['outputs']):
+            return False
+
+        if stat is None:
+            stat = os.stat(filename)
+            stat = FileStat(stat.st_size, stat.st_mtime_ns)
+        if stat.size != entry['size']:
+            return False
+        if stat.mtime == entry['mtime']:
+            return True
+
+        # File was touched - compare content and remember new mtime.
+        if file_hash(filename) != entry['sha1']:
+            return False
+        entry['mtime'] = stat.mtime
+        return True
+
+    def update(self, filename, outputs, options=None, digest=None):
+        """
+            Remember processed file, its options and list of its outputs.
+            Content hash is taken from <digest> if it is already known.
+        """
+        stat = os.stat(filename)
+        self.files[self.key(filename)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha1': digest or file_hash(filename),
+            'outputs': [os.path.relpath(output, self.path)
+                        for output in outputs],
+            'options': options or {},
+        }
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.files}, f)
+        os.replace(tmp, self.filename)
@@ -0,0 +1,143 @@
+"""Timings and counters of processing of task by procloc."""
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+METRICS_NAME = 'metrics.json'
+
+
+class TaskMetrics:
+    """
+        Time spent in every stage and counters of task, in total and
+        for every processed file.
+    """
+
+    def __init__(self, task_id=None, on_progress=None):
+        self.task_id = task_id
+        # Called with current stage, count of done and total files.
+        self.on_progress = on_progress
+        self.started = time.time()
+        self.duration = None
+        self.stages = defaultdict(float)
+        self.counters = Counter()
+        self.files = {}
+
+    def file(self, name):
+        """Return record of metrics of file <name>."""
+        return self.files.setdefault(name, {
+            'stages': defaultdict(float),
+            'counters': Counter()
+        })
+
+    @contextmanager
+    def stage(self, name, file=None):
+        """Measure time of stage <name> of task or of its file."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started, file)
+
+    def add_time(self, name, seconds, file=None):
+        self.stages[name] += seconds
+        if file is not None:
+            self.file(file)['stages'][name] += seconds
+
+    def count(self, name, value=1, file=None):
+        self.counters[name] += value
+        if file is not None:
+            self.file(file)['counters'][name] += value
+
+    def merge(self, other):
+        """Add metrics <other> of files processed in another process."""
+        for name, seconds in other.stages.items():
+            self.stages[name] += seconds
+        self.counters.update(other.counters)
+        for name, record in other.files.items():
+            own = self.file(name)
+            for stage, seconds in record['stages'].items():
+                own['stages'][stage] += seconds
+            own['counters'].update(record['counters'])
+
+    def progress(self, stage):
+        """Report current stage and count of done files of task."""
+        if self.on_progress is None:
+            return
+        done = sum(self.counters[name] for name in
+                   ('files_processed', 'files_skipped', 'files_failed'))
+        self.on_progress(stage, done, self.counters['files_total'])
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    def summary(self):
+        """Return aggregates of task without records of files."""
+        return {
+            'task_id': self.task_id,
+            'started': self.started,
+            'duration': self.duration,
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+        }
+
+    def save(self, path):
+        """Save all metrics with records of files to <path>/metrics.json."""
+        content = self.summary()
+        content['files'] = self.files
+        with open(os.path.join(path, METRICS_NAME), 'w') as f:
+            json.dump(content, f, indent=1)
+
+
+def add_totals(totals, summary):
+    """
+        Add summary of finished task to running <totals> of all tasks:
+        stage times, counters and duration. Return new totals.
+    """
+    stages = Counter(totals.get('stages', {}))
+    stages.update(summary.get('stages', {}))
+    counters = Counter(totals.get('counters', {}))
+    counters.update(summary.get('counters', {}))
+    totals = {
+        'stages': dict(stages),
+        'counters': dict(counters),
+        'duration_sum': totals.get('duration_sum', 0),
+        'duration_count': totals.get('duration_count', 0),
+    }
+    if summary.get('duration') is not None:
+        totals['duration_sum'] += summary['duration']
+        totals['duration_count'] += 1
+    return totals
+
+
+def label(value):
+    """Escape <value> of label in Prometheus text format."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def prometheus(totals):
+    """
+        Return running <totals> of all tasks made by add_totals in
+        Prometheus text format.
+    """
+    lines = [
+        '# HELP procloc_stage_seconds_total Time spent in stage of processing.',
+        '# TYPE procloc_stage_seconds_total counter',
+    ]
+    for stage, seconds in sorted(totals.get('stages', {}).items()):
+        lines.append(f'procloc_stage_seconds_total{{stage="{label(stage)}"}} '
+                     f'{seconds:.6f}')
+    for name, value in sorted(totals.get('counters', {}).items()):
+        lines.append(f'# TYPE procloc_{name}_total counter')
+        lines.append(f'procloc_{name}_total {value}')
+    lines += [
+        '# HELP procloc_task_duration_seconds Duration of processing of task.',
+        '# TYPE procloc_task_duration_seconds summary',
+        'procloc_task_duration_seconds_sum '
+        f'{totals.get("duration_sum", 0):.6f}',
+        'procloc_task_duration_seconds_count '
+        f'{totals.get("duration_count", 0)}',
+    ]
+    return '\n'.join(lines) + '\n'
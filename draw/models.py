@@ -1,15 +1,117 @@
-from django.db import models
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from .metrics import add_totals
 
 
 class Task(models.Model):
     """Task and it's status of proccessing - creating a shot of map."""
+    STATUS_QUEUED = "Добавленa в очередь на обработку"
+    STATUS_PROCESSING = "Обрабатывается"
+    STATUS_DONE = "Завершена."
+    STATUS_FAILED = "Ошибка обработки."
+
     id = models.AutoField(primary_key=True)
     year = models.CharField(max_length=5)
     depart = models.CharField(max_length=30)
     sz = models.CharField(max_length=200)
     dateTime_added = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20)
+    status = models.CharField(max_length=40)
+    # Progress of processing, updated by worker after every file.
+    stage = models.CharField(max_length=20, blank=True)
+    files_total = models.IntegerField(default=0)
+    # Processed, skipped as not changed and failed files.
+    files_done = models.IntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    # Aggregated metrics of processing, metrics of every file are saved
+    # to metrics.json in directory of task.
+    duration = models.FloatField(null=True, blank=True)
+    files_processed = models.IntegerField(default=0)
+    files_failed = models.IntegerField(default=0)
+    metrics = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dateTime_added']),
+            models.Index(fields=['status']),
+            models.Index(fields=['updated_at']),
+        ]
 
     def __str__(self):
         """Return a string representation of the model."""
         return f"{self.sz}"
+
+    @classmethod
+    def claim_next(cls):
+        """Atomically take the oldest queued task for processing.
+        Return None if there are no queued tasks."""
+        queued = cls.objects.filter(status=cls.STATUS_QUEUED)
+        for task in queued.order_by('dateTime_added')[:10]:
+            # Only one worker can change status from queued.
+            now = timezone.now()
+            if queued.filter(id=task.id).update(
+                    status=cls.STATUS_PROCESSING, started_at=now,
+                    updated_at=now):
+                task.status = cls.STATUS_PROCESSING
+                task.started_at = task.updated_at = now
+                return task
+        return None
+
+    @classmethod
+    def reclaim_stale(cls, seconds):
+        """Queue again tasks in processing without progress for <seconds>,
+        their worker has died. Return count of such tasks."""
+        deadline = timezone.now() - timedelta(seconds=seconds)
+        return cls.objects.filter(status=cls.STATUS_PROCESSING,
+                                  updated_at__lt=deadline).update(
+                                      status=cls.STATUS_QUEUED, stage='',
+                                      updated_at=timezone.now())
+
+    @classmethod
+    def requeue(cls, task_id):
+        """Queue again task claimed but not started by worker."""
+        cls.objects.filter(id=task_id,
+                           status=cls.STATUS_PROCESSING).update(
+                               status=cls.STATUS_QUEUED, stage='',
+                               started_at=None, updated_at=timezone.now())
+
+    @classmethod
+    def set_progress(cls, task_id, stage, done, total):
+        """Save progress of task without loading it."""
+        cls.objects.filter(id=task_id).update(stage=stage,
+                                              files_done=done,
+                                              files_total=total,
+                                              updated_at=timezone.now())
+
+    def save(self, *args, **kwargs):
+        """Mark task as changed for polling of progress."""
+        self.updated_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'updated_at'}
+        super().save(*args, **kwargs)
+
+
+class MetricsTotal(models.Model):
+    """Running totals of metrics of all finished tasks, the only row."""
+    id = models.AutoField(primary_key=True)
+    totals = models.JSONField(default=dict)
+
+    @classmethod
+    def add(cls, summary):
+        """Add metrics <summary> of finished task to totals."""
+        with transaction.atomic():
+            row, _ = cls.objects.select_for_update().get_or_create(id=1)
+            row.totals = add_totals(row.totals, summary)
+            row.save(update_fields=['totals'])
+
+    @classmethod
+    def current(cls):
+        """Return totals, empty if no task has finished yet."""
+        row = cls.objects.filter(id=1).first()
+        return row.totals if row is not None else {}
@@ -0,0 +1,88 @@
+"""Persistent columnar cache of parsed loc-files."""
+import glob
+import os
+
+import pyarrow.feather as feather
+
+# Directory and size limit (in bytes) of cache of parsed files.
+PARSE_CACHE_DIR = os.path.expanduser('~/.cache/draw/parsed')
+PARSE_CACHE_SIZE = 2 * 1024**3
+
+
+class ParseCache:
+    """
+        Dataframes df_loc and df_dt of parsed loc-files saved in Feather
+        format. Entry is addressed by hash of file content and version of
+        parsers, so entries of old parsers are never read.
+    """
+
+    def __init__(self, version, cache_dir=PARSE_CACHE_DIR,
+                 max_size=PARSE_CACHE_SIZE):
+        self.version = version
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def paths(self, digest, version=None):
+        """Return paths of df_loc and df_dt files of cache entry."""
+        prefix = os.path.join(self.cache_dir, digest[:2],
+                              f"{digest}.v{version or self.version}")
+        return prefix + '.loc.feather', prefix + '.dt.feather'
+
+    def load(self, digest):
+        """
+            Return memory-mapped df_loc and df_dt of file with
+            content hash <digest> or None if there is no such entry.
+        """
+        try:
+            parsed = tuple(
+                feather.read_table(path, memory_map=True).to_pandas()
+                for path in self.paths(digest))
+            # To mark entry as recently used.
+            for path in self.paths(digest):
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        return parsed
+
+    def store(self, digest, df_loc, df_dt):
+        """Save dataframes of file with content hash <digest>."""
+        os.makedirs(os.path.join(self.cache_dir, digest[:2]), exist_ok=True)
+
+        # To remove entries of the same file made by old parsers.
+        for path in glob.glob(os.path.join(self.cache_dir, digest[:2],
+                                           f"{digest}.v*.feather")):
+            if path not in self.paths(digest):
+                os.remove(path)
+
+        for dframe, path in zip((df_loc, df_dt), self.paths(digest)):
+            # Uncompressed files can be memory-mapped without copying.
+            tmp = f"{path}.{os.getpid()}.tmp"
+            feather.write_feather(dframe, tmp, compression='uncompressed')
+            os.replace(tmp, path)
+
+    def purge(self):
+        """
+            Remove all entries made by other versions of parsers and
+            least recently used entries over the size limit.
+        """
+        suffix = f".v{self.version}."
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.feather')):
+            try:
+                if suffix not in os.path.basename(path):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,30 +1,78 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
 import os
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pyproj import Transformer
+import numpy as np
 import pandas as pd
-import mapnik
+import pyarrow as pa
+import pyarrow.compute as pc
 import datetime
 import logging
-
-
-def define_unique(dirName):
-    """
-        Return a dictionary of unique filenames in directory dirName
-        with keys=filenames and values=file extensions.
-    """
-
-    files = {}
-    for folderName, subfolders, filenames in os.walk(dirName):
-        for i in filenames:
-            if os.path.splitext(i)[1] in ['.ext1', '.ext2', '.ext3']:
-                files.setdefault(os.path.splitext(i)[0], [])
-                files[os.path.splitext(i)[0]].append(os.path.splitext(i)[1])
-    logging.info('Inside this directory next files was founded: files = %s',
-                 files)
-    return files
+from urllib.parse import urlencode
+
+from draw import render, report
+from draw.discovery import LOC_SUFFIX, discover
+from draw.manifest import Manifest, file_hash
+from draw.metrics import TaskMetrics
+from draw.parsecache import PARSE_CACHE_DIR, ParseCache
+from draw.spatial import SPATIAL_DB, SpatialIndex
+
+# Version of parsers - change it with any change of parsed dataframes,
+# so cached results of old parsers are not used.
+PARSER_VERSION = 1
+
+# Complex regex for lines of file's part with statistic of locations.
+COORD_REGEX = re.compile(
+    r'''
+    (?P<countEvents>^\d+)               # Count of events.
+    \s+\(                               # Just space and open parenthesis.
+    ((?P<percentage>\d+(\.\w*)?))?      # Percentage from total events.
+    (%\))?                              # Percentage of total events.
+    # LAC and CellID.
+    (\s+-\s(?P<operator>\D)(?P<param2>\d*)-(?P<param3>\w*)\s*-)?
+    (\s*(?P<address>.*)\()?             # Address's text description.
+    ((?P<lat>\w*),)?                    # Latitude in DMS.
+    (\s*(?P<lon>\w*),)?                 # Longitude.
+    (\s+(?P<azimuth>\d*)\s+-)?          # Azimuth.
+    ''', re.VERBOSE)
+
+# Regexes for tab-separated fields of file's part with date and time.
+ADDR_REGEX = re.compile(r"((?P<address>.*)\()?", re.VERBOSE)
+PARAM1_REGEX = re.compile(r"=((?P<param1>\d*))?")
+PARAM2_CID_REGEX = re.compile(
+    r"=((?P<operator>\D*)(?P<param2>\d*)-(?P<param3>\w*))?", re.VERBOSE)
+
+# Columns of dataframe with date and time of events.
+DT_COLUMNS = ['dateTime', 'param1', 'operator', 'param2', 'param3', 'address']
+
+# Default URL of draw:marker view rendering map images on request, web
+# worker passes the URL reversed where the app is really mounted.
+MARKER_URL = "/draw/marker.png"
+
+# Count of processes processing files of task concurrently.
+FILE_WORKERS = 4
+
+# Page with links to reports of all numbers of task.
+INDEX_NAME = 'loc_analyze_index.html'
+
+# Sections of loc-file after the header line, they are separated
+# by the first and the second blank lines.
+LOC_SECTIONS = ('chronology', 'summary', 'statistics')
+
+# Count of lines passed to parsers at once.
+CHUNK_SIZE = 100000
+
+# Columns of dataframe with statistic of locations.
+LOC_COLUMNS = [
+    'countEvents', 'percentage', 'operator', 'param2', 'param3', 'address',
+    'lat', 'latDD', 'lon', 'lonDD', 'azimuth'
+]
 
 
 def find_locationPart(txtFile):
@@ -64,18 +112,12 @@ def parse_main_part(lines, dframe):
         'address': ''
     }
 
-    # To create complex regular expression:
-    addr_regexp = re.compile(r"((?P<address>.*)\()?", re.VERBOSE)
-    param1_regexp = re.compile(r"=((?P<param1>\d*))?")
-    param2_cid_regexp = re.compile(
-        r"=((?P<operator>\D*)(?P<param2>\d*)-(?P<param3>\w*))?", re.VERBOSE)
-
     # Looping over partition of file to excerpt useful information:
     for stroke in lines:
         # Excerpt data from lines by regular expression
-        mo_addr = addr_regexp.search(stroke.split('\t')[-1])
-        mo_param1 = param1_regexp.search(stroke.split('\t')[1])
-        mo_param2_cid = param2_cid_regexp.search(stroke.split('\t')[2])
+        mo_addr = ADDR_REGEX.search(stroke.split('\t')[-1])
+        mo_param1 = PARAM1_REGEX.search(stroke.split('\t')[1])
+        mo_param2_cid = PARAM2_CID_REGEX.search(stroke.split('\t')[2])
 
         # Next, fill the dictionary dictF.
         dictF['dateTime'] = stroke.split('\t')[0]
@@ -95,6 +137,79 @@ def parse_main_part(lines, dframe):
     return dframe
 
 
+def _search_unique(column, regex, names):
+    """
+        Search <regex> in every distinct value of arrow string <column>
+        only once. Return object arrays of groups <names> for all values.
+    """
+    encoded = pc.dictionary_encode(column)
+    found = [regex.search(value) for value in encoded.dictionary.to_pylist()]
+    indices = encoded.indices.to_numpy(zero_copy_only=False)
+    groups = []
+    for name in names:
+        values = np.array([None] * len(found), dtype=object)
+        values[:] = [match.group(name) for match in found]
+        groups.append(values[indices])
+    return groups
+
+
+def _check_lines(valid, message, first_line):
+    """
+        Raise ValueError with <message> about the first line not marked
+        in boolean array <valid>, lines are numbered from <first_line>.
+    """
+    if not valid.all():
+        number = first_line + int(np.argmin(valid))
+        raise ValueError(f"Line {number} of chronology {message}.")
+
+
+def parse_main_part_batch(lines, first_line=1):
+    """
+        Vectorized version of parse_main_part: lines of file's partition
+        are split by tab in arrow at once. Fields with cell site and address
+        repeat a lot, so regexes are searched in their distinct values only.
+        Return a dataframe with columns DT_COLUMNS built in one step.
+        Raise ValueError naming a wrong line, lines are numbered from
+        <first_line>.
+    """
+    if not lines:
+        return pd.DataFrame({column: [] for column in DT_COLUMNS})
+
+    fields = pc.split_pattern(pa.array(lines, type=pa.string()), '\t')
+    counts = pc.list_value_length(fields).to_numpy(zero_copy_only=False)
+    _check_lines(counts >= 3, "has less than 3 fields", first_line)
+
+    # The last field of every line is taken by offsets of lists.
+    last = pc.take(pc.list_flatten(fields),
+                   pa.array(fields.offsets.to_numpy()[1:] - 1))
+    param1 = pc.extract_regex(pc.list_element(fields, 1),
+                              r'=(?P<param1>[0-9]*)')
+    _check_lines(
+        pc.is_valid(param1).to_numpy(zero_copy_only=False),
+        "has no '=' in the second field", first_line)
+    cell = pc.list_element(fields, 2)
+    _check_lines(
+        pc.match_substring(cell, '=').to_numpy(zero_copy_only=False),
+        "has no '=' in the third field", first_line)
+
+    operator, param2, param3 = _search_unique(
+        cell, PARAM2_CID_REGEX, ('operator', 'param2', 'param3'))
+    address, = _search_unique(last, ADDR_REGEX, ('address', ))
+    address[pd.isna(address)] = ''
+
+    return pd.DataFrame(
+        {
+            'dateTime':
+            pc.list_element(fields, 0).to_numpy(zero_copy_only=False),
+            'param1': param1.field('param1').to_numpy(zero_copy_only=False),
+            'operator': operator,
+            'param2': param2,
+            'param3': param3,
+            'address': address,
+        },
+        columns=DT_COLUMNS)
+
+
 def extract_coord(lines, dframe):
     """
         Excerpt geographic coordinates from lines of files partition
@@ -116,24 +231,9 @@ def extract_coord(lines, dframe):
         'azimuth': ''
     }
 
-    # To create complex regex:
-    coordRegex = re.compile(
-        r'''
-        (?P<countEvents>^\d+)               # Count of events.
-        \s+\(                               # Just space and open parenthesis.
-        ((?P<percentage>\d+(\.\w*)?))?      # Percentage from total events.
-        (%\))?                              # Percentage of total events.
-        # LAC and CellID.
-        (\s+-\s(?P<operator>\D)(?P<param2>\d*)-(?P<param3>\w*)\s*-)?
-        (\s*(?P<address>.*)\()?             # Address's text description.
-        ((?P<lat>\w*),)?                    # Latitude in DMS.
-        (\s*(?P<lon>\w*),)?                 # Longitude.
-        (\s+(?P<azimuth>\d*)\s+-)?          # Azimuth.
-        ''', re.VERBOSE)
-
     # Looping over partition of file to excerpt useful information:
     for string in lines:
-        mo = coordRegex.search(string)
+        mo = COORD_REGEX.search(string)
         dictF['countEvents'] = float(
             0 if mo.group('countEvents') is None else mo.group('countEvents'))
         dictF['percentage'] = float(
@@ -157,6 +257,38 @@ def extract_coord(lines, dframe):
     return dframe
 
 
+def extract_coord_batch(lines):
+    """
+        Columnar version of extract_coord: excerpt geographic coordinates
+        and statistic information from all lines of files partition at once.
+        Return a dataframe with columns LOC_COLUMNS built in one step.
+    """
+
+    # To run the regex over the whole partition and get a column
+    # for every group (NaN where group was not matched).
+    captures = pd.Series(lines, dtype=object).str.extract(COORD_REGEX)
+
+    def text(name):
+        return captures[name].fillna('')
+
+    lat = text('lat')
+    lon = text('lon')
+    columns = {
+        'countEvents': captures['countEvents'].fillna(0).astype(float),
+        'percentage': captures['percentage'].fillna(0).astype(float),
+        'operator': text('operator'),
+        'param2': text('param2'),
+        'param3': text('param3'),
+        'address': text('address'),
+        'lat': lat,
+        'latDD': dms2dd_array(lat),
+        'lon': lon,
+        'lonDD': dms2dd_array(lon),
+        'azimuth': text('azimuth'),
+    }
+    return pd.DataFrame(columns, columns=LOC_COLUMNS)
+
+
 def dms2dd(crd):
     """
        Convert map coordinate in DMS (degrees, minutes, seconds)
@@ -179,6 +311,32 @@ def dms2dd(crd):
     return crd_dd
 
 
+def dms2dd_array(crds):
+    """
+        Vectorized dms2dd: convert array of map coordinates in DMS
+        to array of decimal degrees. Empty coordinates become 0.
+    """
+    crds = pd.Series(crds, dtype=object).fillna('')
+
+    # Coordinates of the same cell sites repeat a lot, so split
+    # only unique strings and then spread results back.
+    codes, uniques = pd.factorize(crds)
+    parts = pd.Series(uniques, dtype=object).str.extract(
+        r'^(\d+)\D+(\d+)\D+(\d+)').astype(float).fillna(0).to_numpy()
+    crd_deg, crd_min, crd_sec = parts.T
+    crd_dd = crd_deg + crd_min / 60 + crd_sec / (60 * 60)
+    return crd_dd[codes] if len(codes) else np.zeros(0)
+
+
+@lru_cache(maxsize=None)
+def get_transformer():
+    """
+        Return Transformer from EPSG 4326 to EPSG 3857. Setting up PROJ
+        pipeline is expensive, so it is created only once per process.
+    """
+    return Transformer.from_crs("epsg:4326", "epsg:3857")
+
+
 def dd2WebCoord(lat, lon):
     """
         Convert point from geographic coordinate system (EPSG 4326) to
@@ -186,246 +344,651 @@ def dd2WebCoord(lat, lon):
         Return lat, lon in meters.
     """
 
-    transformer = Transformer.from_crs("epsg:4326", "epsg:3857")
-    x, y = transformer.transform(lat, lon)
+    x, y = get_transformer().transform(lat, lon)
     x = round(x, 2)
     y = round(y, 2)
     return (x, y)
 
 
-def render_map(x, y, file, dir_output):
+def dd2WebCoord_array(lat, lon):
     """
-        Render map box with marker in point(lat, lon)
+        Vectorized dd2WebCoord: convert arrays of points from EPSG 4326
+        to EPSG 3857 with one transform call.
+        Return two arrays of coordinates in meters.
     """
-    mapnik_xml = "/home/osm/src/openstreetmap-carto/mapnik.xml"
-    epsg_3857 = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 \
-                 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs"
 
-    # To define the boundaries of box
-    box_bound = [x - 2000, y - 2000, x + 2000, y + 2000]
+    x, y = get_transformer().transform(np.asarray(lat, dtype=float),
+                                       np.asarray(lon, dtype=float))
+    return np.round(x, 2), np.round(y, 2)
 
-    # To create a map object
-    m = mapnik.Map(1024, 1024)
-    mapnik.load_map(m, mapnik_xml)
 
-    # To create point style
-    s = mapnik.Style()  # style object to hold rules
-    r = mapnik.Rule()  # rule object to hold symbolizers
-
-    # To create symbolizer
-    point_sym = mapnik.MarkersSymbolizer()
-    # point_sym.fill = mapnik.Color('red')
-    # point_sym.allow_overlap = True
-    # point_sym.width = mapnik.Expression("90")
-    # point_sym.height = mapnik.Expression("90")
-    # point_sym.opacity = .5
-    # point_sym.strokewidth = mapnik.Expression("2")
-    point_sym.file = 'static/img/marker-icon-2x-red.png'
-    point_sym.allow_overlap = True
+def top_locations(df_loc, count=5):
+    """
+        Group locations by address and coordinates and sum their events.
+        Return <count> most frequent locations in descending order.
+    """
 
-    r.symbols.append(point_sym)  # add the symbolizer to the rule object
-    s.rules.append(r)  # add the rule to the styel object
-    m.append_style('center', s)  # append style to map
+    # To group dataframe by column 'address' and sum by columns
+    # 'countEvents' and 'percentage'.
+    df_by_addr = df_loc.groupby(
+        ['address', 'lat', 'latDD', 'lon',
+         'lonDD'])[['countEvents', 'percentage']].sum().reset_index()
 
-    # To create datasource
-    ds = mapnik.MemoryDatasource()
-    f = mapnik.Feature(mapnik.Context(), 1)
+    # To define most frequent locations in descending order without
+    # sorting of all locations and reset index.
+    return df_by_addr.nlargest(count, 'countEvents').reset_index(drop=True)
 
-    f.geometry = f.geometry.from_wkt("POINT({} {})".format(x, y))
-    ds.add_feature(f)
 
-    center_layer = mapnik.Layer('center_layer')
-    center_layer.srs = epsg_3857
-    center_layer.datasource = ds
-    center_layer.styles.append('center')
-    m.layers.append(center_layer)
+def read_loc_sections(filename, chunk_size=CHUNK_SIZE):
+    """
+        Read loc-file <filename> in one pass and generate pairs
+        (section, lines) for sections 'header', 'chronology', 'summary'
+        and 'statistics' separated by blank lines.
+        Long sections are split into chunks of <chunk_size> lines.
+    """
+    blanks = 0
+    section, chunk = None, []
+    with open(filename, encoding='windows-1251') as f:
+        for number, line in enumerate(f):
+            if number == 0 and line != '\n':
+                current = 'header'
+            elif line == '\n' and blanks < 2:
+                # Two first blank lines separate parts of file.
+                blanks += 1
+                continue
+            else:
+                current = LOC_SECTIONS[blanks]
 
-    bbox = mapnik.Box2d(*box_bound)
-    m.zoom_to_box(bbox)
-    mapnik.render_to_file(m, os.path.join(dir_output,
-                                          (file + '_2000' + '.png')))
-    logging.info(f"\t\tRendered image to {file}_2000.png.")
+            if chunk and (current != section or len(chunk) >= chunk_size):
+                yield section, chunk
+                chunk = []
+            section = current
+            chunk.append(line)
+    if chunk:
+        yield section, chunk
 
 
-def start(path):
+def parse_loc_file(filename, chunk_size=CHUNK_SIZE):
     """
-        Start function.
+        Stream loc-file <filename> and parse its parts with date and time
+        and with statistic of locations chunk by chunk.
+        Return dataframes df_loc and df_dt or None if some part is empty.
     """
 
-    logging.basicConfig(level=logging.DEBUG,
-                        format="%(asctime)s - %(levelname)s - %(message)s",
-                        filename=path + "/render.log")
-    logging.info('Start process task!')
-
-    dictOfLocParam = {
-        'countEvents': [],
-        'percentage': [],
-        'operator': [],
-        'param2': [],
-        'param3': [],
-        'address': [],
-        'lat': [],
-        'latDD': 0,
-        'lon': [],
-        'lonDD': 0,
-        'azimuth': []
-    }
+    loc_frames = []
+    dt_frames = []
+    # No blank lines are skipped before chronology, so count of lines
+    # read before chunk gives number of its first line in file.
+    read = 0
+    for section, lines in read_loc_sections(filename, chunk_size):
+        if section == 'chronology':
+            dt_frames.append(parse_main_part_batch(lines, read + 1))
+        elif section == 'statistics':
+            loc_frames.append(extract_coord_batch(lines))
+        read += len(lines)
+
+    if loc_frames == [] or dt_frames == []:
+        return None
 
-    dictOfLoc_dateTime = {
-        'dateTime': [],
-        'param1': [],
-        'operator': [],
-        'param2': [],
-        'param3': [],
-        'address': []
-    }
+    return (pd.concat(loc_frames, ignore_index=True),
+            pd.concat(dt_frames, ignore_index=True))
 
-    # Content of report html-file.
-    html_first_part = "<html><head><title>Анализ местоположений</title>"
-    html_first_part += "<style>h1, h2, h3 {text-align: center}"
-    html_first_part += "table, th, td {border: 1px solid black"
-    html_first_part += "; border-collapse: collapse; border-spacing:8px}"
-    html_first_part += "th {background-color:#3DBBDB;color:white}"
-    html_first_part += "tr {text-align: center}"
-    html_first_part += "img { border: 1px solid #ddd; /* Gray border */"
-    html_first_part += "border-radius: 4px; /* Rounded border */"
-    html_first_part += "padding: 5px; /* Some padding */"
-    html_first_part += "width: 150px; /* Set a smal width */ }"
-    html_first_part += "img:hover { "
-    html_first_part += "box-shadow: 0 0 2px 1px rgba(0,140,186,0.5)"
-    html_first_part += "; }"
-    html_middle_part = "</style>" + "</head>" + "<body>"
-    html_middle_part += "<h1>Анализ местоположений объекта.</h1>"
-    html_middle_part += "<p>В таблице представлены 5 местоположений с наибольшим "
-    html_middle_part += "количеством событий: </p>"
-    html_end_part = "</body></html>"
-
-    # To find all unique number in request
-    # and save them in <dict_files>
-    dict_files = define_unique(path)
 
-    # To read the style.css file for inserting later in report html-file.
-    with open('report_style.css') as f:
-        styles = f.read()
+def start(path, task_id=None, progress=None, output=None, **options):
+    """
+        Start function. Process directory <path> of task <task_id>,
+        <options> are passed to process_dir. Reports are written to
+        <output>, by default to <path> itself, with log render.log and
+        metrics of files metrics.json. <progress> is called with current
+        stage, count of done files and total count of files.
+        Return aggregated metrics of task. Raise FileNotFoundError if
+        there is no directory <path>.
+    """
+    # Missing directory of task is an error, it is never created.
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"There is no directory {path}.")
+    if output is None:
+        output = path
+    else:
+        os.makedirs(output, exist_ok=True)
+
+    # Handler is added for every task, since basicConfig configures
+    # logging only once per process.
+    handler = logging.FileHandler(os.path.join(output, 'render.log'))
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+    metrics = TaskMetrics(task_id, progress)
+    try:
+        logging.info('Start process task!')
+        process_dir(path, metrics, output, **options)
+    finally:
+        metrics.finish()
+        metrics.save(output)
+        logging.info(f"Task is finished in {metrics.duration:.2f} s: "
+                     f"{dict(metrics.counters)}.")
+        root.removeHandler(handler)
+        handler.close()
+    return metrics.summary()
+
+
+def read_parsed(filename, metrics, file, parse_cache=None):
+    """
+        Take parsed dataframes of loc-file <filename> from <parse_cache>
+        or parse the file. Return df_loc, df_dt and content hash of file,
+        it is kept in manifest. Raise ValueError if some part of file is
+        empty.
+    """
+    with metrics.stage('parse', file):
+        parsed = None
+        digest = file_hash(filename)
+        if parse_cache is not None:
+            parsed = parse_cache.load(digest)
+        if parsed is not None:
+            logging.info("\t\tParsed dataframes are taken from cache.")
+            metrics.count('parse_cache_hits', file=file)
+        else:
+            parsed = parse_loc_file(filename)
+            if parsed is not None and parse_cache is not None:
+                parse_cache.store(digest, *parsed)
 
-    # To read the script.css file for inserting later in report html-file.
-    with open('report_script.js') as f:
-        script = f.read()
+    if parsed is None:
+        raise ValueError(f"There is no chronology or statistics in "
+                         f"{os.path.basename(filename)}.")
+    return parsed + (digest, )
 
-    # To process all files one by one.
-    for file in dict_files:
-        # To create two empty dataframe for each loc-file.
-        df_loc = pd.DataFrame(dictOfLocParam)
-        df_dt = pd.DataFrame(dictOfLoc_dateTime)
 
-        # To choose loc-file.
-        if 'loc' not in dict_files[file]:
+def prepare_file(path, file, filename, metrics, parse_cache=None,
+                 overview=True, closeups=False, spatial=None,
+                 marker_url=MARKER_URL):
+    """
+        Parse loc-file <filename> of number <file> and prepare its report.
+        Locations of file are added to SpatialIndex <spatial> if it is set.
+        Images of locations without closeups refer to view <marker_url>.
+        Return context of report: summary and locations, JSON-files of
+        chronology and jobs for rendering maps to directory <path>, and
+        content hash of file.
+    """
+    df_loc, df_dt, digest = read_parsed(filename, metrics, file, parse_cache)
+    metrics.count('rows_loc', len(df_loc), file)
+    metrics.count('rows_dt', len(df_dt), file)
+
+    if spatial is not None:
+        with metrics.stage('index', file):
+            spatial.add_file(filename, path, file, df_loc)
+
+    with metrics.stage('group', file):
+        # To define five most frequent locations.
+        df_by_addr = top_locations(df_loc)
+
+        # To find rows of every address once, so slices for locations
+        # are just lookups of row positions.
+        dt_rows = df_dt.groupby('address').indices
+        loc_rows = df_loc.groupby('address').indices
+
+    df_for_html = df_by_addr.iloc[:, [0, 2, 4, 5, 6]].rename(
+        columns={
+            'address': 'Адрес',
+            'latDD': 'Широта',
+            'lonDD': 'Долгота',
+            'countEvents': 'Кол-во событий тех.',
+            'percentage': '%'
+        })
+
+    # Context of report: summary table and then every location.
+    summary = {'table': df_for_html.to_html(), 'overview': None}
+    locations = []
+
+    # JSON-files with big chronology tables of locations.
+    outputs = []
+
+    # To convert coordinates of first five max locations
+    # from EPSG4326 to EPSG3857 at once.
+    with metrics.stage('project', file):
+        web_x, web_y = dd2WebCoord_array(df_by_addr['latDD'],
+                                         df_by_addr['lonDD'])
+
+    # Jobs for rendering maps of this file.
+    jobs = []
+
+    # Empty coordinates are projected to point (0, 0), so locations
+    # without them are not drawn at all.
+    located = [
+        row.address != 'No address' and row.lat != '' and row.lon != ''
+        for row in df_by_addr.itertuples()
+    ]
+
+    # To render all locations with coordinates on one overview map.
+    points = [(web_x[row[0]], web_y[row[0]])
+              for row in df_by_addr.itertuples() if located[row[0]]]
+    if overview and points:
+        jobs.append(
+            render.RenderJob(points,
+                             os.path.join(path, f"{file}_overview.png"),
+                             2000))
+        summary['overview'] = f"{file}_overview.png"
+
+    # To select from df_loc all rows for first five max locations.
+    for row in df_by_addr.itertuples():
+        if not located[row[0]]:
             logging.info(
-                f'Warning! There is no location file for this number - {file}.'
-            )
-            continue
+                "There are no coordinates for this location so do \
+                         not render the map.")
         else:
-            filename = os.path.join(path, (file + 'loc'))
+            # Then render map for this points (coordinates).
+            if closeups:
+                jobs.append(
+                    render.RenderJob(
+                        [(web_x[row[0]], web_y[row[0]])],
+                        os.path.join(path, f"{file}_{row[0]}_2000.png"),
+                        2000))
+
+            if closeups:
+                image = thumbnail = f"{file}_{row[0]}_2000.png"
+            else:
+                query = {'x': web_x[row[0]], 'y': web_y[row[0]]}
+                image = f"{marker_url}?{urlencode(query)}"
+                thumbnail = f"{image}&size=150"
+
+            # Fill the context of location in report file.
+            location = {
+                'number': str(row[0]),
+                'address': row[1],
+                'count': str(row[6]),
+                'image': image,
+                'thumbnail': thumbnail,
+                'events': df_loc.take(loc_rows.get(
+                    row[1], [])).reset_index(drop=True).to_html(),
+            }
+            json_output = os.path.join(path,
+                                       f"{file}_chronology{row[0]}.json")
+            location.update(
+                report.chronology(
+                    df_dt.take(dt_rows.get(row[1],
+                                           [])).reset_index(drop=True),
+                    json_output))
+            if location['chronology_url']:
+                outputs.append(json_output)
+            locations.append(location)
+
+    return summary, locations, outputs, jobs, digest
+
+
+def finish_file(path, file, summary, locations, outputs, jobs, futures,
+                stage, metrics, style=report.REPORT_STYLE,
+                script=report.REPORT_SCRIPT):
+    """
+        Wait for images of number <file> and write its report to directory
+        <path> with <style> and <script> files included.
+        Return all outputs of file or None if some images failed.
+    """
+    # Time of waiting for images is counted as render stage of task,
+    # time of rendering itself - as render stage of file.
+    rendered, seconds = stage.rendered, stage.render_seconds
+    with metrics.stage('render'):
+        failed = stage.collect(futures, jobs)
+    metrics.file(file)['stages']['render'] += stage.render_seconds - seconds
+    metrics.count('renders', stage.rendered - rendered, file)
+    metrics.count('render_failures', len(failed), file)
+
+    # Create a report html-file.
+    output = report_name(path, file)
+    with metrics.stage('report', file):
+        report.write_report(output, summary, locations, style, script)
+
+    # File with failed renders will be processed again next time.
+    if failed:
+        return None
+    return [output] + outputs + [job.output for job in jobs]
 
-        # To open loc-file.
-        with open(filename, encoding='windows-1251') as f:
-            # To read file and save content in <lines>.
-            lines = f.readlines()
 
-        # To find out all empty line indices in file.
-        empty_lines_index = find_locationPart(lines)
-        logging.info('********************************************')
-        logging.info(
-            f"\tStart to process file: {os.path.basename(filename) }.")
-        logging.info(f"\t\tEmpty line indices: {empty_lines_index}")
+def report_name(path, file):
+    """Return name of report html-file of number <file>."""
+    return os.path.join(path, 'loc_analyze_' + file + '.html')
 
-        # To save second part of file with date and time.
-        loc_dt_filepart = lines[1:empty_lines_index[0] - 1]
 
-        # To save third part of file with location statistic:
-        loc_stat_filepart = lines[empty_lines_index[1]:]
+@lru_cache(maxsize=None)
+def file_stage(mapnik_xml=render.MAPNIK_XML, marker_file=render.MARKER_FILE):
+    """Return render stage of file worker, maps are rendered inline."""
+    return render.RenderStage(0, mapnik_xml, marker_file=marker_file)
 
-        # To process part of file with statistic of location:
-        if loc_stat_filepart != [] and loc_dt_filepart != []:
-            print('********************************************')
-            print(filename)
 
-            # To extract location data and save in dataframe.
-            df_loc = extract_coord(loc_stat_filepart, df_loc)
+def process_file(path, file, filename, parse_cache_dir=PARSE_CACHE_DIR,
+                 overview=True, closeups=False, spatial_db=SPATIAL_DB,
+                 mapnik_xml=render.MAPNIK_XML, style=report.REPORT_STYLE,
+                 script=report.REPORT_SCRIPT, marker_file=render.MARKER_FILE,
+                 marker_url=MARKER_URL):
+    """
+        Process loc-file <filename> of number <file> in file worker,
+        outputs are written to directory <path>.
+        Return its outputs (None if some images failed), content hash and
+        metrics.
+    """
+    metrics = TaskMetrics()
+    parse_cache = None
+    if parse_cache_dir is not None:
+        parse_cache = ParseCache(PARSER_VERSION, parse_cache_dir)
+    spatial = None
+    if spatial_db is not None:
+        spatial = SpatialIndex(spatial_db)
+    stage = file_stage(mapnik_xml, marker_file)
+    if stage.cache is not None:
+        hits, misses = stage.cache.hits, stage.cache.misses
+
+    try:
+        summary, locations, outputs, jobs, digest = prepare_file(
+            path, file, filename, metrics, parse_cache, overview, closeups,
+            spatial, marker_url)
+    finally:
+        if spatial is not None:
+            spatial.close()
+    futures = [stage.submit(job) for job in jobs]
+    outputs = finish_file(path, file, summary, locations, outputs, jobs,
+                          futures, stage, metrics, style, script)
+
+    if stage.cache is not None:
+        metrics.count('render_cache_hits', stage.cache.hits - hits)
+        metrics.count('render_cache_misses', stage.cache.misses - misses)
+    return outputs, digest, metrics
+
+
+def process_dir(path, metrics, output=None, workers=render.RENDER_WORKERS,
+                incremental=True, parse_cache_dir=PARSE_CACHE_DIR,
+                overview=True, closeups=False, file_workers=FILE_WORKERS,
+                spatial_db=SPATIAL_DB, mapnik_xml=render.MAPNIK_XML,
+                style=report.REPORT_STYLE, script=report.REPORT_SCRIPT,
+                marker_file=render.MARKER_FILE, marker_url=MARKER_URL):
+    """
+        Process all files of directory <path>, timings and counters
+        are added to <metrics>. Reports, maps and manifest are written
+        to <output>, by default to <path>. Maps are rendered with mapnik
+        stylesheet <mapnik_xml> and marker image <marker_file>, reports
+        include <style> and <script> files. Files processed with other
+        rendering options are not taken as current. Files are processed
+        by <file_workers> processes, every one renders maps of its file
+        itself. With one file worker files are processed one by one in
+        this process and maps are rendered by <workers> processes
+        meanwhile.
+        If <incremental>, files not changed since the last run are skipped.
+        Parsed files are cached in <parse_cache_dir>, None - no cache,
+        cache is trimmed to its size limit after all files.
+        Locations of files are added to spatial index <spatial_db>.
+        If <overview>, all top locations are rendered on one map.
+        If <closeups>, every location is rendered on its own map now,
+        otherwise report refers to images rendered on request by
+        <marker_url>.
+        Broken file is only logged and is listed in index page.
+    """
+    output = output or path
 
-            # To extract datetime data and save in dataframe.
-            df_dt = parse_main_part(loc_dt_filepart, df_dt)
-        else:
-            logging.info('!!!!!!!!C A U T I O N!!!!!!!!!!!!')
-            logging.info(f"ATTENTION: {filename}.")
-            print('ATTENTION')
+    # To find all unique number in request with their files
+    # and save them in <dict_files>
+    with metrics.stage('discovery'):
+        dict_files = discover(path)
+    metrics.count('files_found', len(dict_files))
+    metrics.count('files_total',
+                  sum(LOC_SUFFIX in files for files in dict_files.values()))
+    metrics.progress('discovery')
+    logging.info(f"Inside this directory {len(dict_files)} numbers were found.")
+
+    # To remember processed files and their outputs.
+    manifest = Manifest(output)
+
+    # Options changing outputs of file, they are kept in manifest.
+    render_options = {
+        'overview': overview,
+        'closeups': closeups,
+        'stylesheet': mapnik_xml,
+        'marker': marker_file,
+        'marker_url': marker_url,
+    }
+
+    # Rows of index page of reports, one for every number.
+    index = {}
 
-            # To escape this file and go to the next.
+    # Files to process: number and name of loc-file.
+    todo = []
+    for file in dict_files:
+        # To choose loc-file.
+        if LOC_SUFFIX not in dict_files[file]:
+            logging.info(
+                f'Warning! There is no location file for this number - {file}.'
+            )
+            index[file] = {'number': file, 'error': 'Нет файла loc.'}
+            continue
+        else:
+            loc_info = dict_files[file][LOC_SUFFIX]
+            filename = loc_info.path
+
+        # To skip file whose outputs are already current.
+        if incremental and manifest.is_current(filename, loc_info,
+                                               render_options):
+            logging.info(f"\tFile {os.path.basename(filename)} is not changed.")
+            metrics.count('files_skipped')
+            metrics.progress('skip')
+            index[file] = {
+                'number': file,
+                'report': report_name(output, file)
+            }
             continue
+        todo.append((file, filename))
+
+    def done(file, filename, outputs, digest):
+        metrics.count('files_processed')
+        metrics.progress('report')
+        index[file] = {'number': file, 'report': report_name(output, file)}
+        if outputs is not None:
+            manifest.update(filename, outputs, render_options, digest)
+        logging.info(f"\tFinish to process file {os.path.basename(filename)}.")
+
+    def fail(file, filename, exc):
+        logging.error(f"Failed to process file {filename}: {exc!r}",
+                      exc_info=exc)
+        metrics.count('files_failed')
+        metrics.file(file)['error'] = repr(exc)
+        metrics.progress('parse')
+        index[file] = {'number': file, 'error': str(exc) or repr(exc)}
+
+    stage = render.RenderStage(workers if file_workers <= 1 else 0,
+                               mapnik_xml, marker_file=marker_file)
+    parse_cache = None
+    if parse_cache_dir is not None:
+        parse_cache = ParseCache(PARSER_VERSION, parse_cache_dir)
+
+    # Options of processing of every file.
+    options = {
+        'parse_cache_dir': parse_cache_dir,
+        'overview': overview,
+        'closeups': closeups,
+        'spatial_db': spatial_db,
+        'mapnik_xml': mapnik_xml,
+        'style': style,
+        'script': script,
+        'marker_file': marker_file,
+        'marker_url': marker_url,
+    }
 
-        # To group dataframe by column 'address' and sum by columns
-        # 'countEvents' and 'percentage'.
-        df_by_addr = df_loc.groupby(
-            ['address', 'lat', 'latDD', 'lon',
-             'lonDD'])[['countEvents', 'percentage']].sum().reset_index()
-
-        # To define most frequent locations by sorting in descending
-        # order and reset index.
-        df_by_addr = df_by_addr.sort_values(
-            'countEvents', ascending=False).reset_index(drop=True)
-
-        # Html tags container for image and table.
-        html_container = ""
-
-        df_for_html = df_by_addr.iloc[:5, [0, 2, 4, 5, 6]].rename(
-            columns={
-                'address': 'Адрес',
-                'latDD': 'Широта',
-                'lonDD': 'Долгота',
-                'countEvents': 'Кол-во событий тех.',
-                'percentage': '%'
-            })
-        html_container += "<p>" + df_for_html.to_html() + "</p>"
-        html_container += "<br><hr>"
-        html_container += "<h3>Ниже представлены снимки карт указанных местоположений. "
-        html_container += "Также представлена подробная информация"
-        html_container += "(см. последние цифры ID).</h3>"
-
-        # To select from df_loc all rows for first five max locations.
-        for row in df_by_addr.iloc[:5, :].itertuples():
-            if row[1] == 'No address':
-                logging.info(
-                    "There are no coordinates for this location so do \
-                             not render the map.")
+    if file_workers > 1 and len(todo) > 1:
+        # Every file is processed in its own worker, so broken file
+        # stops only its worker.
+        with ProcessPoolExecutor(max_workers=file_workers) as executor:
+            futures = {
+                executor.submit(process_file, output, file, filename,
+                                **options):
+                (file, filename)
+                for file, filename in todo
+            }
+            for future in as_completed(futures):
+                file, filename = futures[future]
+                try:
+                    outputs, digest, file_metrics = future.result()
+                except Exception as exc:
+                    fail(file, filename, exc)
+                    continue
+                metrics.merge(file_metrics)
+                done(file, filename, outputs, digest)
+    else:
+        spatial = None
+        if spatial_db is not None:
+            spatial = SpatialIndex(spatial_db)
+
+        # Files with renders in progress, their reports are not written yet.
+        pending = []
+
+        def write_report(file, filename, digest, *context):
+            try:
+                outputs = finish_file(output, file, *context, stage, metrics,
+                                      style, script)
+            except Exception as exc:
+                fail(file, filename, exc)
             else:
-                # To choose only columns 3 and 5 (latDD and lonDD values).
-                x, y = row[3:6:2]
-
-                # To convert coordinates from EPSG4326 to EPSG3857.
-                x, y = dd2WebCoord(x, y)
-
-                # Then render map for this points (coordinates).
-                render_map(x, y, file + '_' + str(row[0]), path)
-
-                # Fill the html-content part of report file.
-                html_container += f"<p>{row[0]} - {row[1]}"
-                html_container += f" - {row[6]} событий. "
-                html_container += f"<a href=\"javascript:PopUpShow('#chronology{row[0]}')\">"
-                html_container += "Хронология по этому МП.</a></p>"
-                html_container += f"<div class='b-popup' id='chronology{row[0]}'><div class='wrapper'>"
-                html_container += "<div class='b-popup-content'>"
-                html_container += f"<a href=\"javascript:PopUpHide('#chronology{row[0]}')\">Скрыть</a><br>"
-                html_container += "<div class='popup_internal'>"
-                html_container += f"{df_dt[df_dt['address'] == row[1]].reset_index(drop=True).to_html()}</div></div></div></div>"
-                html_container += f"<a target='_blank' href=\"{file}_{row[0]}_2000.png\">"
-                html_container += f"<img src=\"{file}_{row[0]}_2000.png\" alt=\"Location\"></a>"
-                html_container += "<h4>Кол-во событий :</h4>"
-                html_container += f"{df_loc[df_loc['address']==row[1]].reset_index(drop=True).to_html()}<br><hr width='50%'><br>"
-
-        # Create a report html-file.
-        with open(os.path.join(path, 'loc_analyze_' + file + '.html'),
-                  'w') as f:
-            f.write(html_first_part + styles + html_middle_part +
-                    html_container + script + html_end_part)
+                done(file, filename, outputs, digest)
 
-        logging.info(f"\tFinish to process file {os.path.basename(filename)}.")
+        # To process all files one by one.
+        for file, filename in todo:
+            logging.info('********************************************')
+            logging.info(
+                f"\tStart to process file: {os.path.basename(filename) }.")
+            metrics.progress('parse')
+            try:
+                summary, locations, outputs, jobs, digest = prepare_file(
+                    output, file, filename, metrics, parse_cache, overview,
+                    closeups, spatial, marker_url)
+            except Exception as exc:
+                fail(file, filename, exc)
+                continue
+
+            # To send jobs to workers and go to the next file while
+            # rendering.
+            futures = [stage.submit(job) for job in jobs]
+            pending.append((file, filename, digest, summary, locations,
+                            outputs, jobs, futures))
+
+            # To write reports of files whose images are already done.
+            while pending and all(future.done()
+                                  for future in pending[0][-1]):
+                write_report(*pending.pop(0))
+
+        # To wait for the rest of images and write their reports.
+        metrics.progress('render')
+        for item in pending:
+            write_report(*item)
+        if spatial is not None:
+            spatial.close()
+
+    stage.shutdown()
+    if stage.cache is not None:
+        metrics.count('render_cache_hits', stage.cache.hits)
+        metrics.count('render_cache_misses', stage.cache.misses)
+        # File workers store images to the same cache, but never evict.
+        if metrics.counters['render_cache_misses'] > stage.cache.misses:
+            stage.cache.evict()
+    manifest.save()
+    if parse_cache is not None:
+        parse_cache.purge()
+
+    # To write index page with links to reports of all numbers.
+    report.write_index(os.path.join(output, INDEX_NAME),
+                       [index[file] for file in sorted(index)])
+
+
+def output_dirs(paths, output_root):
+    """
+        Return output directory in <output_root> for every input
+        directory of <paths>, relative paths of inputs are kept.
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    if output_root is None:
+        return paths
+    common = os.path.commonpath(paths)
+    if len(paths) == 1:
+        common = os.path.dirname(common)
+    return [
+        os.path.join(output_root, os.path.relpath(path, common))
+        for path in paths
+    ]
+
+
+def main(argv=None):
+    """
+        Command-line entry point: process directories with loc-files
+        without web server. Failed directory is reported and the next
+        one is processed. Return 1 if some directories or files failed.
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m draw.procloc',
+        description="Analyze loc-files of directories and write reports.")
+    parser.add_argument('paths', nargs='+', metavar='DIR',
+                        help="Directories with loc-files.")
+    parser.add_argument('-o', '--output',
+                        help="Root directory of reports, by default reports "
+                        "are written to input directories.")
+    parser.add_argument('-w', '--workers', type=int,
+                        default=os.cpu_count() or FILE_WORKERS,
+                        help="Count of processes processing files.")
+    parser.add_argument('--render-workers', type=int,
+                        default=render.RENDER_WORKERS,
+                        help="Count of render processes with one worker.")
+    parser.add_argument('--stylesheet', default=render.MAPNIK_XML,
+                        help="Mapnik XML stylesheet of maps.")
+    parser.add_argument('--marker', default=render.MARKER_FILE,
+                        help="Marker image of maps.")
+    parser.add_argument('--marker-url', default=MARKER_URL,
+                        help="URL of view rendering images of locations.")
+    parser.add_argument('--style', default=report.REPORT_STYLE,
+                        help="CSS file included in reports.")
+    parser.add_argument('--script', default=report.REPORT_SCRIPT,
+                        help="JS file included in reports.")
+    parser.add_argument('--no-render', dest='render', action='store_false',
+                        help="Do not render maps, reports refer to images "
+                        "rendered on request.")
+    parser.add_argument('--closeups', action='store_true',
+                        help="Render map of every location.")
+    parser.add_argument('--full', action='store_true',
+                        help="Process not changed files too.")
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help="Do not cache parsed files.")
+    parser.add_argument('--no-spatial', action='store_true',
+                        help="Do not add locations to spatial index.")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for path, output in zip(args.paths, output_dirs(args.paths,
+                                                    args.output)):
+        try:
+            summary = start(
+                path,
+                output=output,
+                workers=args.render_workers,
+                file_workers=args.workers,
+                incremental=not args.full,
+                parse_cache_dir=None
+                if args.no_parse_cache else PARSE_CACHE_DIR,
+                spatial_db=None if args.no_spatial else SPATIAL_DB,
+                overview=args.render,
+                closeups=args.render and args.closeups,
+                mapnik_xml=os.path.abspath(args.stylesheet),
+                marker_file=os.path.abspath(args.marker),
+                marker_url=args.marker_url,
+                style=os.path.abspath(args.style),
+                script=os.path.abspath(args.script))
+        except Exception as exc:
+            logging.error(f"Failed to process directory {path}: {exc!r}",
+                          exc_info=exc)
+            print(f"{path} -> {output}: failed: {exc}", file=sys.stderr)
+            failed += 1
+            continue
+        counters = summary['counters']
+        failed += counters.get('files_failed', 0)
+        print(f"{path} -> {output}: {counters.get('files_processed', 0)} "
+              f"processed, {counters.get('files_skipped', 0)} skipped, "
+              f"{counters.get('files_failed', 0)} failed in "
+              f"{summary['duration']:.1f} s.")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
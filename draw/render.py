@@ -0,0 +1,415 @@
+"""Rendering of map boxes with markers by Mapnik."""
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache
+
+import mapnik
+
+MAPNIK_XML = "/home/osm/src/openstreetmap-carto/mapnik.xml"
+EPSG_3857 = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 \
+             +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs"
+# Marker image in static files of project, directory above this app.
+MARKER_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'static/img/marker-icon-2x-red.png')
+MAP_SIZE = 1024
+
+# Bound of coordinates of EPSG 3857 in meters, both for x and y.
+EPSG_3857_BOUND = 20037508.34
+
+# Count of worker processes for rendering, 0 - render in current process.
+RENDER_WORKERS = 4
+
+# Directory and size limit (in bytes) of cache of rendered images.
+RENDER_CACHE_DIR = os.path.expanduser('~/.cache/draw/render')
+RENDER_CACHE_SIZE = 2 * 1024**3
+
+# Cache filled on request is checked for size after this count of renders.
+RENDER_CACHE_EVICT_EVERY = 100
+
+# Width in pixels of markers of the 2nd, 3rd and so on locations,
+# the 1st one has native size of marker image.
+RANK_MARKER_WIDTHS = (40, 34, 28, 22)
+
+# Padding around all markers on the overview map, part of their extent.
+OVERVIEW_PADDING = 0.2
+
+# Sizes in pixels of images rendered on request.
+MARKER_SIZES = (150, 300, 512, 1024)
+
+# Job for rendering: points of markers in EPSG 3857 ordered by rank,
+# path of output image and minimal half of side of map box in meters.
+RenderJob = namedtuple('RenderJob', ['points', 'output', 'half_size'])
+
+
+class MapRenderer:
+    """
+        Mapnik map with loaded stylesheet and registered 'center' style
+        of markers ranked by attribute 'rank'. Only datasource of marker
+        layer and bbox are changed per render.
+    """
+
+    def __init__(self, mapnik_xml=MAPNIK_XML, size=MAP_SIZE,
+                 marker_file=MARKER_FILE):
+        # To create a map object and parse stylesheet only once.
+        self.map = mapnik.Map(size, size)
+        mapnik.load_map(self.map, mapnik_xml)
+
+        # To create point style, markers are smaller for lower ranks.
+        s = mapnik.Style()  # style object to hold rules
+        for rank, width in enumerate((None, ) + RANK_MARKER_WIDTHS, 1):
+            r = mapnik.Rule()  # rule object to hold symbolizers
+            if rank <= len(RANK_MARKER_WIDTHS):
+                r.filter = mapnik.Expression(f"[rank] = {rank}")
+            else:
+                # All other ranks have the smallest markers.
+                r.filter = mapnik.Expression(f"[rank] >= {rank}")
+
+            # To create symbolizer
+            point_sym = mapnik.MarkersSymbolizer()
+            point_sym.file = marker_file
+            point_sym.allow_overlap = True
+            if width is not None:
+                point_sym.width = mapnik.Expression(str(width))
+
+            r.symbols.append(point_sym)  # add the symbolizer to the rule
+            s.rules.append(r)  # add the rule to the style object
+        self.map.append_style('center', s)  # append style to map
+
+        # To create layer for markers, its datasource is swapped per render.
+        center_layer = mapnik.Layer('center_layer')
+        center_layer.srs = EPSG_3857
+        center_layer.datasource = mapnik.MemoryDatasource()
+        center_layer.styles.append('center')
+        self.map.layers.append(center_layer)
+        self.layer_index = len(self.map.layers) - 1
+        self.context = mapnik.Context()
+        self.context.push('rank')
+
+    def render(self, points, output, half_size=2000):
+        """
+            Render map box with markers in points [(x, y), ...] to file
+            <output>. Box is centered on the markers and is big enough
+            to show all of them with padding.
+        """
+        # To create datasource with markers, the first point has rank 1.
+        ds = mapnik.MemoryDatasource()
+        for rank, (x, y) in enumerate(points, 1):
+            f = mapnik.Feature(self.context, rank)
+            f['rank'] = rank
+            f.geometry = f.geometry.from_wkt("POINT({} {})".format(x, y))
+            ds.add_feature(f)
+        self.map.layers[self.layer_index].datasource = ds
+
+        # To define the boundaries of box
+        xs, ys = zip(*points)
+        x, y = (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2
+        extent = max(max(xs) - min(xs), max(ys) - min(ys))
+        half_size = max(half_size, extent / 2 * (1 + OVERVIEW_PADDING))
+        bbox = mapnik.Box2d(x - half_size, y - half_size, x + half_size,
+                            y + half_size)
+        self.map.zoom_to_box(bbox)
+
+        # Output may be a hardlink of cache entry, so new image is written
+        # to another file and replaces the link, the entry is kept intact.
+        tmp = f"{output}.{os.getpid()}.{threading.get_ident()}.tmp.png"
+        mapnik.render_to_file(self.map, tmp)
+        os.replace(tmp, output)
+
+
+class MapPool:
+    """
+        Small pool of MapRenderer objects. Renderers are created lazily
+        up to <size> and reused, so stylesheet is loaded once per renderer.
+    """
+
+    def __init__(self, size=1, mapnik_xml=MAPNIK_XML, map_size=MAP_SIZE,
+                 marker_file=MARKER_FILE):
+        self.size = size
+        self.mapnik_xml = mapnik_xml
+        self.marker_file = marker_file
+        self.map_size = map_size
+        self._free = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def renderer(self):
+        """Borrow a renderer from pool, wait if all of them are busy."""
+        with self._lock:
+            create = self._free.empty() and self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                renderer = MapRenderer(self.mapnik_xml, self.map_size,
+                                       self.marker_file)
+            except Exception:
+                # To let the next caller try to create renderer again.
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            renderer = self._free.get()
+        try:
+            yield renderer
+        finally:
+            self._free.put(renderer)
+
+
+@lru_cache(maxsize=None)
+def get_pool(mapnik_xml=MAPNIK_XML, map_size=MAP_SIZE,
+             marker_file=MARKER_FILE):
+    """Return pool of renderers for stylesheet, one per process."""
+    return MapPool(mapnik_xml=mapnik_xml, map_size=map_size,
+                   marker_file=marker_file)
+
+
+def link_or_copy(source, destination):
+    """Hardlink file <source> to <destination>, copy if can't link."""
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    tmp = f"{destination}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+
+class RenderCache:
+    """
+        On-disk cache of rendered images. Entry is addressed by rounded
+        point, half size of box, image size and hash of stylesheet.
+        Least recently used entries are evicted when cache grows over
+        <max_size> bytes.
+    """
+
+    def __init__(self, cache_dir=RENDER_CACHE_DIR, max_size=RENDER_CACHE_SIZE,
+                 mapnik_xml=MAPNIK_XML, map_size=MAP_SIZE,
+                 marker_file=MARKER_FILE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.map_size = map_size
+        self.hits = 0
+        self.misses = 0
+
+        # Any change of stylesheet or marker must invalidate the cache.
+        digest = hashlib.sha1()
+        for path in (mapnik_xml, marker_file):
+            try:
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+            except OSError:
+                digest.update(path.encode())
+        self.stylesheet_hash = digest.hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, job):
+        """Return path of cache entry for render job."""
+        points = ';'.join(f"{x:.0f}:{y:.0f}" for x, y in job.points)
+        key = (f"{points}:{job.half_size}:{self.map_size}:"
+               f"{self.stylesheet_hash}")
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.png')
+
+    def fetch(self, job):
+        """
+            Put cached image of job to its output.
+            Return True on cache hit.
+        """
+        entry = self.path(job)
+        try:
+            # To mark entry as recently used.
+            os.utime(entry)
+            link_or_copy(entry, job.output)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, job):
+        """Save rendered output of job to cache."""
+        entry = self.path(job)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        link_or_copy(job.output, entry)
+
+    def evict(self):
+        """Remove least recently used entries over the size limit."""
+        entries = []
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+@lru_cache(maxsize=None)
+def get_cache(cache_dir=RENDER_CACHE_DIR, mapnik_xml=MAPNIK_XML,
+              map_size=MAP_SIZE):
+    """Return cache of images of size <map_size>, one per process."""
+    return RenderCache(cache_dir, RENDER_CACHE_SIZE, mapnik_xml, map_size)
+
+
+def cached_path(points, half_size=2000, map_size=MAP_SIZE,
+                mapnik_xml=MAPNIK_XML):
+    """Return path of cache entry of image with markers in points."""
+    cache = get_cache(RENDER_CACHE_DIR, mapnik_xml, map_size)
+    return cache.path(RenderJob(points, None, half_size))
+
+
+def render_cached(points, half_size=2000, map_size=MAP_SIZE,
+                  mapnik_xml=MAPNIK_XML):
+    """
+        Return path of cached image with markers in points, render
+        the image by preloaded map only if it isn't in cache yet.
+    """
+    cache = get_cache(RENDER_CACHE_DIR, mapnik_xml, map_size)
+    entry = cache.path(RenderJob(points, None, half_size))
+    try:
+        # To mark entry as recently used.
+        os.utime(entry)
+        cache.hits += 1
+        return entry
+    except FileNotFoundError:
+        cache.misses += 1
+
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    with get_pool(mapnik_xml, map_size).renderer() as renderer:
+        renderer.render(points, entry, half_size)
+
+    # Nothing else evicts entries rendered on request.
+    if cache.misses % RENDER_CACHE_EVICT_EVERY == 0:
+        cache.evict()
+    return entry
+
+
+def _init_worker(mapnik_xml, marker_file=MARKER_FILE):
+    """Preload map in the worker process before the first job."""
+    with get_pool(mapnik_xml, MAP_SIZE, marker_file).renderer():
+        pass
+
+
+def _render_job(job, mapnik_xml, cache=None, marker_file=MARKER_FILE):
+    """
+        Render one job by preloaded map of the current process.
+        Return time of rendering in seconds.
+    """
+    started = time.perf_counter()
+    with get_pool(mapnik_xml, MAP_SIZE, marker_file).renderer() as renderer:
+        renderer.render(job.points, job.output, job.half_size)
+    if cache is not None:
+        cache.store(job)
+    return time.perf_counter() - started
+
+
+class RenderStage:
+    """
+        Stage of rendering: jobs are sent to a pool of worker processes,
+        each of them has its own preloaded map.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, mapnik_xml=MAPNIK_XML,
+                 cache_dir=RENDER_CACHE_DIR, cache_size=RENDER_CACHE_SIZE,
+                 marker_file=MARKER_FILE):
+        self.mapnik_xml = mapnik_xml
+        self.marker_file = marker_file
+        # Counters of rendered images, failed renders and time of renders.
+        self.rendered = 0
+        self.failed = 0
+        self.render_seconds = 0.0
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = RenderCache(cache_dir, cache_size, mapnik_xml,
+                                     marker_file=marker_file)
+        self.executor = None
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(mapnik_xml,
+                                                          marker_file))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.cache is not None:
+            logging.info(f"Render cache: {self.cache.hits} hits, "
+                         f"{self.cache.misses} misses.")
+            # Eviction scans the whole cache, so it is done only when
+            # new images were stored to it.
+            if self.cache.misses:
+                self.cache.evict()
+
+    def submit(self, job):
+        """
+            Send job to workers. Return a future with time of rendering
+            as result, it is None if image was taken from cache.
+        """
+        future = Future()
+
+        # The same point was already rendered - just take image from cache.
+        if self.cache is not None and self.cache.fetch(job):
+            future.set_result(None)
+            return future
+
+        if self.executor is not None:
+            return self.executor.submit(_render_job, job, self.mapnik_xml,
+                                        self.cache, self.marker_file)
+
+        # Without workers render right now in the current process.
+        try:
+            future.set_result(
+                _render_job(job, self.mapnik_xml, self.cache,
+                            self.marker_file))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def collect(self, futures, jobs):
+        """
+            Wait for futures of jobs and report failed renders.
+            Return a list of failed jobs.
+        """
+        wait(futures)
+        failed = []
+        for future, job in zip(futures, jobs):
+            if future.exception() is None:
+                if future.result() is not None:
+                    self.rendered += 1
+                    self.render_seconds += future.result()
+                logging.info(f"\t\tRendered image to {job.output}.")
+            else:
+                self.failed += 1
+                logging.error(f"\t\tFailed to render {job.output}: "
+                              f"{future.exception()!r}")
+                failed.append(job)
+        return failed
@@ -0,0 +1,177 @@
+"""Report html-files with analysis of locations of subscriber."""
+import os
+from functools import lru_cache
+
+from django.template import Context, Engine
+
+REPORT_STYLE = 'report_style.css'
+REPORT_SCRIPT = 'report_script.js'
+
+# Chronology of location with more rows is saved to separate JSON-file
+# and is loaded by report only when it is opened.
+CHRONOLOGY_INLINE_ROWS = 1000
+
+HEAD = (
+    "<html><head><title>Анализ местоположений</title>"
+    "<style>h1, h2, h3 {text-align: center}"
+    "table, th, td {border: 1px solid black"
+    "; border-collapse: collapse; border-spacing:8px}"
+    "th {background-color:#3DBBDB;color:white}"
+    "tr {text-align: center}"
+    "img { border: 1px solid #ddd; /* Gray border */"
+    "border-radius: 4px; /* Rounded border */"
+    "padding: 5px; /* Some padding */"
+    "width: 150px; /* Set a smal width */ }"
+    "img:hover { "
+    "box-shadow: 0 0 2px 1px rgba(0,140,186,0.5)"
+    "; }"
+    "{{ styles|safe }}</style></head><body>"
+    "<h1>Анализ местоположений объекта.</h1>"
+    "<p>В таблице представлены 5 местоположений с наибольшим "
+    "количеством событий: </p>")
+
+SUMMARY = (
+    "<p>{{ table|safe }}</p><br><hr>"
+    "<h3>Ниже представлены снимки карт указанных местоположений. "
+    "Также представлена подробная информация"
+    "(см. последние цифры ID).</h3>"
+    "{% if overview %}<a target='_blank' href=\"{{ overview }}\">"
+    "<img src=\"{{ overview }}\" alt=\"Overview\"></a><br><hr>{% endif %}")
+
+LOCATION = (
+    "<p>{{ number }} - {{ address }} - {{ count }} событий. "
+    "<a href=\"javascript:{% if chronology_url %}"
+    "loadChronology('#chronology{{ number }}');{% endif %}"
+    "PopUpShow('#chronology{{ number }}')\">"
+    "Хронология по этому МП.</a></p>"
+    "<div class='b-popup' id='chronology{{ number }}'><div class='wrapper'>"
+    "<div class='b-popup-content'>"
+    "<a href=\"javascript:PopUpHide('#chronology{{ number }}')\">Скрыть</a>"
+    "<br><div class='popup_internal'>"
+    "{% if chronology_url %}<div class='lazy_chronology' "
+    "data-src=\"{{ chronology_url }}\">Загрузка...</div>"
+    "{% else %}{{ chronology|safe }}{% endif %}</div></div></div></div>"
+    "<a target='_blank' href=\"{{ image }}\">"
+    "<img src=\"{{ thumbnail }}\" alt=\"Location\"></a>"
+    "<h4>Кол-во событий :</h4>{{ events|safe }}<br><hr width='50%'><br>")
+
+# Script builds table of chronology from JSON-file on the first opening.
+LAZY_SCRIPT = """<script>
+function loadChronology(id) {
+    var box = document.querySelector(id + ' .lazy_chronology');
+    if (!box || box.dataset.loaded) return;
+    box.dataset.loaded = '1';
+    fetch(box.dataset.src).then(function (response) {
+        return response.json();
+    }).then(function (data) {
+        var table = document.createElement('table');
+        table.className = 'dataframe';
+        var row = table.insertRow();
+        [''].concat(data.columns).forEach(function (name) {
+            var th = document.createElement('th');
+            th.textContent = name;
+            row.appendChild(th);
+        });
+        data.data.forEach(function (values, i) {
+            row = table.insertRow();
+            row.insertCell().textContent = data.index[i];
+            values.forEach(function (value) {
+                row.insertCell().textContent = value === null ? 'None' : value;
+            });
+        });
+        box.textContent = '';
+        box.appendChild(table);
+    });
+}
+</script>"""
+
+TAIL = (
+    "{% if lazy %}{{ lazy_script|safe }}{% endif %}"
+    "{{ script|safe }}</body></html>")
+
+
+INDEX = (
+    "<html><head><title>Анализ местоположений</title>"
+    "<style>h1 {text-align: center}"
+    "table, th, td {border: 1px solid black"
+    "; border-collapse: collapse; padding: 4px}"
+    "th {background-color:#3DBBDB;color:white}</style></head><body>"
+    "<h1>Отчеты по объектам задачи.</h1><table><tr><th>Объект</th>"
+    "<th>Отчет</th></tr>"
+    "{% for row in rows %}<tr><td>{{ row.number }}</td><td>"
+    "{% if row.report %}<a href=\"{{ row.report }}\">Открыть</a>"
+    "{% else %}Ошибка: {{ row.error }}{% endif %}</td></tr>{% endfor %}"
+    "</table></body></html>")
+
+
+@lru_cache(maxsize=None)
+def templates():
+    """Return compiled templates of report parts, once per process."""
+    engine = Engine(autoescape=True)
+    return {
+        name: engine.from_string(source)
+        for name, source in (('head', HEAD), ('summary', SUMMARY),
+                             ('location', LOCATION), ('tail', TAIL),
+                             ('index', INDEX))
+    }
+
+
+@lru_cache(maxsize=None)
+def static_assets(style=REPORT_STYLE, script=REPORT_SCRIPT):
+    """Return content of style and script files, read once per process."""
+    with open(style) as f:
+        styles = f.read()
+    with open(script) as f:
+        scripts = f.read()
+    return styles, scripts
+
+
+def chronology(dframe, json_output):
+    """
+        Return context of chronology table of location: html of table or,
+        for a big table, name of JSON-file <json_output> it is saved to.
+        Both keys are always set, so templates never miss a variable.
+    """
+    if len(dframe) <= CHRONOLOGY_INLINE_ROWS:
+        return {'chronology': dframe.to_html(), 'chronology_url': None}
+    dframe.to_json(json_output, orient='split', force_ascii=False)
+    return {'chronology': '', 'chronology_url': os.path.basename(json_output)}
+
+
+def write_report(output, summary, locations, style=REPORT_STYLE,
+                 script=REPORT_SCRIPT):
+    """
+        Write report html-file <output> part by part: summary table with
+        overview map and then every location, so parts are not joined
+        into one big string. Contexts of all locations are prepared
+        before and kept in <locations> until the report is written.
+    """
+    parts = templates()
+    styles, scripts = static_assets(style, script)
+    lazy = False
+    with open(output, 'w') as f:
+        f.write(parts['head'].render(Context({'styles': styles})))
+        f.write(parts['summary'].render(Context(summary)))
+        for location in locations:
+            lazy = lazy or bool(location.get('chronology_url'))
+            f.write(parts['location'].render(Context(location)))
+        f.write(parts['tail'].render(
+            Context({
+                'lazy': lazy,
+                'lazy_script': LAZY_SCRIPT,
+                'script': scripts
+            })))
+
+
+def write_index(output, rows):
+    """
+        Write index html-file <output> with a row for every number:
+        link to its report or error of processing.
+    """
+    rows = [{
+        'number': row['number'],
+        'report': os.path.basename(row['report']) if row.get('report') else '',
+        'error': row.get('error', ''),
+    } for row in rows]
+    with open(output, 'w') as f:
+        f.write(templates()['index'].render(Context({'rows': rows})))
@@ -0,0 +1,302 @@
+"""Persistent spatial index of locations of all processed loc-files."""
+import math
+import os
+import sqlite3
+
+import pandas as pd
+
+SPATIAL_DB_NAME = 'locations.sqlite3'
+
+# Mean radius of the Earth in meters for distances between points.
+EARTH_RADIUS = 6371008.8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    source TEXT UNIQUE NOT NULL,
+    task TEXT NOT NULL,
+    number TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sites (
+    id INTEGER PRIMARY KEY,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    operator TEXT NOT NULL,
+    param2 TEXT NOT NULL,
+    param3 TEXT NOT NULL,
+    count_events REAL NOT NULL DEFAULT 0,
+    UNIQUE (lat, lon, operator, param2, param3)
+);
+CREATE INDEX IF NOT EXISTS sites_events ON sites(count_events);
+CREATE VIRTUAL TABLE IF NOT EXISTS sites_rtree
+    USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    site_id INTEGER NOT NULL REFERENCES sites(id),
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    operator TEXT,
+    param2 TEXT,
+    param3 TEXT,
+    count_events REAL,
+    address TEXT
+);
+CREATE INDEX IF NOT EXISTS locations_file ON locations(file_id);
+CREATE INDEX IF NOT EXISTS locations_site ON locations(site_id);
+DROP TABLE IF EXISTS locations_rtree;
+CREATE TEMP TABLE IF NOT EXISTS new_locations (
+    lat REAL,
+    lon REAL,
+    operator TEXT,
+    param2 TEXT,
+    param3 TEXT,
+    count_events REAL,
+    address TEXT,
+    site_operator TEXT,
+    site_param2 TEXT,
+    site_param3 TEXT
+);
+CREATE TEMP TABLE IF NOT EXISTS old_sites (id INTEGER PRIMARY KEY);
+"""
+
+# Columns of rows returned by queries.
+COLUMNS = ('number', 'task', 'lat', 'lon', 'operator', 'param2', 'param3',
+           'count_events', 'address')
+
+SELECT = """
+SELECT f.number, f.task, l.lat, l.lon, l.operator, l.param2, l.param3,
+       l.count_events, l.address
+FROM sites_rtree AS r
+JOIN locations AS l ON l.site_id = r.id
+JOIN files AS f ON f.id = l.file_id
+WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?
+"""
+
+SITE_COLUMNS = ('id', 'lat', 'lon', 'operator', 'param2', 'param3',
+                'count_events')
+
+
+def spatial_db_path():
+    """
+        Return path of database: DRAW_SPATIAL_DB environment variable or
+        setting, otherwise file next to sqlite database of Django, so web
+        server and workers of any user share it. Without Django it is in
+        cache directory of the current user.
+    """
+    path = os.environ.get('DRAW_SPATIAL_DB')
+    if path:
+        return path
+    try:
+        from django.conf import settings
+        if settings.configured:
+            path = getattr(settings, 'DRAW_SPATIAL_DB', None)
+            if path:
+                return str(path)
+            database = settings.DATABASES['default']
+            if database['ENGINE'].endswith('sqlite3'):
+                return os.path.join(
+                    os.path.dirname(os.path.abspath(database['NAME'])),
+                    SPATIAL_DB_NAME)
+    except ImportError:
+        pass
+    return os.path.expanduser(os.path.join('~/.cache/draw', SPATIAL_DB_NAME))
+
+
+SPATIAL_DB = spatial_db_path()
+
+
+class SpatialIndex:
+    """
+        SQLite database with locations (latDD, lonDD, operator, param2,
+        param3, countEvents) of all loc-files. Location has the point of
+        its cell site, so points of sites only are indexed by R-tree.
+        Locations of file are replaced when it is processed again.
+        Events of every cell site over all files are summed in table
+        sites when files are added, so top sites are read by index.
+    """
+
+    def __init__(self, path=SPATIAL_DB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Files of task may be added by several processes at once.
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add_file(self, source, task, number, df_loc):
+        """
+            Replace locations of loc-file <source> of number <number> in
+            directory <task> by rows of <df_loc> with coordinates.
+        """
+        # Empty coordinates are converted to 0 degrees, such rows are
+        # not locations at all.
+        rows = df_loc[(df_loc['lat'] != '') & (df_loc['lon'] != '')].dropna(
+            subset=['latDD', 'lonDD'])
+        locations = pd.DataFrame({
+            'lat': rows['latDD'],
+            'lon': rows['lonDD'],
+            'operator': rows['operator'],
+            'param2': rows['param2'],
+            'param3': rows['param3'],
+            'count_events': rows['countEvents'],
+            'address': rows['address'],
+        })
+        # Cell site is the same for empty and missing values.
+        for column in ('operator', 'param2', 'param3'):
+            locations[f"site_{column}"] = locations[column].fillna('')
+
+        # Events of every cell site of file are summed once.
+        sites = locations.groupby(
+            ['lat', 'lon', 'site_operator', 'site_param2', 'site_param3'],
+            sort=False)['count_events'].sum()
+
+        with self.db:
+            self.db.execute(
+                'INSERT INTO files (source, task, number) VALUES (?, ?, ?) '
+                'ON CONFLICT(source) DO UPDATE SET task = excluded.task, '
+                'number = excluded.number', (source, task, number))
+            file_id = self.db.execute('SELECT id FROM files WHERE source = ?',
+                                      (source, )).fetchone()[0]
+            self._remove_locations(file_id)
+
+            # New sites get ids over the greatest id of sites.
+            last_site = self.db.execute(
+                'SELECT COALESCE(MAX(id), 0) FROM sites').fetchone()[0]
+            self.db.executemany(
+                'INSERT INTO sites (lat, lon, operator, param2, param3, '
+                'count_events) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(lat, lon, operator, param2, param3) DO UPDATE '
+                'SET count_events = count_events + excluded.count_events',
+                (site + (float(events), ) for site, events in sites.items()))
+
+            # Locations find their sites by unique index of sites, NaN
+            # is saved as NULL by SQLite.
+            self.db.execute('DELETE FROM new_locations')
+            self.db.executemany(
+                'INSERT INTO new_locations VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                locations.itertuples(index=False, name=None))
+            self.db.execute(
+                'INSERT INTO locations (file_id, site_id, lat, lon, '
+                'operator, param2, param3, count_events, address) '
+                'SELECT ?, s.id, n.lat, n.lon, n.operator, n.param2, '
+                'n.param3, n.count_events, n.address FROM new_locations AS n '
+                'JOIN sites AS s ON s.lat = n.lat AND s.lon = n.lon '
+                'AND s.operator = n.site_operator '
+                'AND s.param2 = n.site_param2 AND s.param3 = n.site_param3',
+                (file_id, ))
+            self.db.execute(
+                'INSERT INTO sites_rtree SELECT id, lat, lat, lon, lon '
+                'FROM sites WHERE id > ?', (last_site, ))
+            self._remove_sites()
+        return len(rows)
+
+    def _remove_locations(self, file_id):
+        """
+            Remove locations of file and their events from cell sites.
+            Sites of file are remembered, so _remove_sites removes those
+            of them not seen in any file after the file is added again.
+        """
+        self.db.execute('DELETE FROM old_sites')
+        self.db.execute(
+            'INSERT INTO old_sites SELECT DISTINCT site_id FROM locations '
+            'WHERE file_id = ?', (file_id, ))
+        self.db.execute(
+            'UPDATE sites SET count_events = count_events - '
+            '(SELECT COALESCE(SUM(count_events), 0) FROM locations '
+            'WHERE file_id = ? AND site_id = sites.id) '
+            'WHERE id IN (SELECT id FROM old_sites)', (file_id, ))
+        self.db.execute('DELETE FROM locations WHERE file_id = ?',
+                        (file_id, ))
+
+    def _remove_sites(self):
+        """Remove remembered cell sites without locations."""
+        self.db.execute(
+            'DELETE FROM old_sites WHERE EXISTS '
+            '(SELECT 1 FROM locations WHERE site_id = old_sites.id)')
+        self.db.execute('DELETE FROM sites WHERE id IN '
+                        '(SELECT id FROM old_sites)')
+        self.db.execute('DELETE FROM sites_rtree WHERE id IN '
+                        '(SELECT id FROM old_sites)')
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, limit=1000):
+        """Return locations inside box, the most frequent first."""
+        cursor = self.db.execute(
+            SELECT + 'ORDER BY l.count_events DESC LIMIT ?',
+            (max_lat, min_lat, max_lon, min_lon, limit))
+        return [dict(zip(COLUMNS, row)) for row in cursor]
+
+    def radius(self, lat, lon, meters, limit=1000):
+        """
+            Return locations not farther than <meters> from point
+            (lat, lon) with their distance, the nearest first.
+        """
+        # Box around circle is searched by R-tree, then distances are
+        # checked only for points of box.
+        dlat = math.degrees(meters / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        cursor = self.db.execute(
+            SELECT, (lat + dlat, lat - dlat, lon + dlon, lon - dlon))
+        found = []
+        for row in cursor:
+            location = dict(zip(COLUMNS, row))
+            location['distance'] = distance(lat, lon, location['lat'],
+                                            location['lon'])
+            if location['distance'] <= meters:
+                found.append(location)
+        found.sort(key=lambda location: location['distance'])
+        return found[:limit]
+
+    def top(self, count=10, box=None):
+        """
+            Return <count> cell sites with most events over all numbers,
+            inside <box> (min_lat, min_lon, max_lat, max_lon) if it is set.
+            Every site has list of numbers seen there.
+        """
+        if box is None:
+            found = ('SELECT id, lat, lon, operator, param2, param3, '
+                     'count_events FROM sites '
+                     'ORDER BY count_events DESC, id LIMIT ?')
+            params = (count, )
+        else:
+            min_lat, min_lon, max_lat, max_lon = box
+            found = ('SELECT s.id, s.lat, s.lon, s.operator, s.param2, '
+                     's.param3, s.count_events FROM sites_rtree AS r '
+                     'JOIN sites AS s ON s.id = r.id '
+                     'WHERE r.min_lat <= ? AND r.max_lat >= ? '
+                     'AND r.min_lon <= ? AND r.max_lon >= ? '
+                     'ORDER BY s.count_events DESC, s.id LIMIT ?')
+            params = (max_lat, min_lat, max_lon, min_lon, count)
+
+        # Numbers of all found sites are taken by the same query.
+        cursor = self.db.execute(
+            f'WITH top AS ({found}) '
+            'SELECT DISTINCT top.*, f.number FROM top '
+            'JOIN locations AS l ON l.site_id = top.id '
+            'JOIN files AS f ON f.id = l.file_id '
+            'ORDER BY top.count_events DESC, top.id, f.number', params)
+
+        sites = {}
+        for row in cursor:
+            site = sites.get(row[0])
+            if site is None:
+                site = sites[row[0]] = dict(zip(SITE_COLUMNS, row[:-1]))
+                site['numbers'] = []
+            site['numbers'].append(row[-1])
+        for site in sites.values():
+            del site['id']
+            site['subscribers'] = len(site['numbers'])
+        return list(sites.values())
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Return distance in meters between two points in degrees."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2)**2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2)**2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
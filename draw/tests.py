@@ -1,3 +1,482 @@
-from django.test import TestCase
+import os
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+import pandas as pd
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from . import procloc, render
+from .catalog import Catalog
+from .discovery import FileInfo, discover
+from .manifest import FileStat, Manifest
+from .models import Task
+from .spatial import SpatialIndex
+
+DT_LINES = [
+    "01.02.2020 10:11:12\tIMSI=25000\tLAC-CID=A1003-3ff\t"
+    "Город, улица 3 (55d3m20sN, 37d36m3sE)\n",
+    "02.02.2020 10:11:12\tIMSI=25001\tLAC-CID=A1005-5ff\t"
+    "Город, улица 5 (55d5m20sN, 37d36m5sE)\n",
+    "03.02.2020 10:11:12\tIMSI=25002\tLAC-CID=A1003-3ff\t"
+    "Город, улица 3 (55d3m20sN, 37d36m3sE)\n",
+    "04.02.2020 10:11:12\tIMSI=25003\tLAC-CID=\tбез адреса\n",
+]
+
+STAT_LINES = [
+    "63 (4.83%) - A1007-7ff - Город, улица 7 (55d7m20sN, 37d36m7sE, 120 -\n",
+    "62 (9.38%) - A1008-8ff - Город, улица 8 (55d8m20sN, 37d36m8sE, 120 -\n",
+    "5 (1%) - B1-2 - nothing\n",
+]
+
+
+class ParserTests(SimpleTestCase):
+    """Batch parsers give the same dataframes as per-line ones."""
+
+    def test_extract_coord_batch(self):
+        expected = procloc.extract_coord(
+            STAT_LINES, pd.DataFrame(columns=procloc.LOC_COLUMNS))
+        pd.testing.assert_frame_equal(procloc.extract_coord_batch(STAT_LINES),
+                                      expected, check_dtype=False)
+
+    def test_parse_main_part_batch(self):
+        expected = procloc.parse_main_part(
+            DT_LINES, pd.DataFrame(columns=procloc.DT_COLUMNS))
+        pd.testing.assert_frame_equal(procloc.parse_main_part_batch(DT_LINES),
+                                      expected, check_dtype=False)
+
+    def test_parse_main_part_batch_short_lines(self):
+        lines = DT_LINES + ["05.02.2020\tIMSI=1\n"]
+        with self.assertRaisesRegex(ValueError, "Line 5 of chronology"):
+            procloc.parse_main_part_batch(lines)
+        with self.assertRaisesRegex(ValueError, "Line 14 of chronology"):
+            procloc.parse_main_part_batch(lines, first_line=10)
+
+    def test_parse_main_part_batch_wrong_fields(self):
+        for line in ("05.02.2020\tIMSI\tLAC-CID=A1-1\tГород\n",
+                     "05.02.2020\tIMSI=1\tLAC-CID\tГород\n"):
+            with self.assertRaisesRegex(ValueError, "Line 2 of chronology"):
+                procloc.parse_main_part_batch(DT_LINES[:1] + [line])
+
+    def test_parse_loc_file_wrong_line(self):
+        # Wrong line is named by its number in file.
+        lines = (["Абонент\n"] + DT_LINES + ["05.02.2020\n", "\n", "\n"] +
+                 STAT_LINES)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, '111loc')
+            with open(filename, 'w', encoding='windows-1251') as f:
+                f.writelines(lines)
+            with self.assertRaisesRegex(ValueError, "Line 6 of chronology"):
+                procloc.parse_loc_file(filename, chunk_size=3)
+
+    def test_empty_parts(self):
+        self.assertEqual(list(procloc.parse_main_part_batch([]).columns),
+                         procloc.DT_COLUMNS)
+        self.assertEqual(len(procloc.extract_coord_batch([])), 0)
+
+
+class ReadLocSectionsTests(SimpleTestCase):
+    """Sections of loc-file are separated by two first blank lines."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, '111loc')
+
+    def sections(self, lines, chunk_size=procloc.CHUNK_SIZE):
+        with open(self.filename, 'w', encoding='windows-1251') as f:
+            f.writelines(lines)
+        return [(section, len(chunk)) for section, chunk in
+                procloc.read_loc_sections(self.filename, chunk_size)]
+
+    def test_all_sections(self):
+        lines = (["Абонент\n"] + DT_LINES + ["\n", "Всего: 4\n", "\n"] +
+                 STAT_LINES)
+        self.assertEqual(self.sections(lines), [('header', 1),
+                                                ('chronology', 4),
+                                                ('summary', 1),
+                                                ('statistics', 3)])
+
+    def test_chunks(self):
+        lines = ["Абонент\n"] + DT_LINES + ["\n", "\n"] + STAT_LINES
+        self.assertEqual(self.sections(lines, chunk_size=3),
+                         [('header', 1), ('chronology', 3), ('chronology', 1),
+                          ('statistics', 3)])
+
+    def test_one_blank_line(self):
+        lines = ["Абонент\n"] + DT_LINES + ["\n", "Всего: 4\n"]
+        self.assertEqual(self.sections(lines), [('header', 1),
+                                                ('chronology', 4),
+                                                ('summary', 1)])
+        # File without statistics is not parsed.
+        self.assertIsNone(procloc.parse_loc_file(self.filename))
+
+    def test_no_blank_lines(self):
+        self.assertEqual(self.sections(["Абонент\n"] + DT_LINES),
+                         [('header', 1), ('chronology', 4)])
+        self.assertIsNone(procloc.parse_loc_file(self.filename))
+
+    def test_blank_first_line(self):
+        # Blank first line is the first separator, so file has no
+        # chronology.
+        lines = ["\n"] + DT_LINES + ["\n"] + STAT_LINES
+        self.assertEqual(self.sections(lines), [('summary', 4),
+                                                ('statistics', 3)])
+        self.assertIsNone(procloc.parse_loc_file(self.filename))
+
+    def test_blank_lines_in_statistics(self):
+        lines = ["Абонент\n", "\n", "\n"] + STAT_LINES + ["\n"]
+        self.assertEqual(self.sections(lines), [('header', 1),
+                                                ('statistics', 4)])
+
+
+class ManifestTests(SimpleTestCase):
+    """Manifest tells files whose outputs are still current."""
+
+    options = {'overview': True, 'closeups': False}
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+        self.filename = os.path.join(self.path, '111loc')
+        self.output = os.path.join(self.path, 'loc_analyze_111.html')
+        for name, content in ((self.filename, 'loc'), (self.output, 'html')):
+            with open(name, 'w') as f:
+                f.write(content)
+        manifest = Manifest(self.path)
+        manifest.update(self.filename, [self.output], self.options)
+        manifest.save()
+
+    def test_current(self):
+        self.assertTrue(
+            Manifest(self.path).is_current(self.filename, None, self.options))
+
+    def test_unknown_file(self):
+        self.assertFalse(Manifest(self.path).is_current(
+            os.path.join(self.path, '222loc'), None, self.options))
+
+    def test_other_options(self):
+        options = dict(self.options, closeups=True)
+        self.assertFalse(
+            Manifest(self.path).is_current(self.filename, None, options))
+
+    def test_missing_output(self):
+        os.remove(self.output)
+        self.assertFalse(
+            Manifest(self.path).is_current(self.filename, None, self.options))
+
+    def test_changed_content(self):
+        # The same size - content is compared by hash.
+        stat = os.stat(self.filename)
+        with open(self.filename, 'w') as f:
+            f.write('LOC')
+        os.utime(self.filename,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertFalse(
+            Manifest(self.path).is_current(self.filename, None, self.options))
+
+    def test_touched_file(self):
+        # Only mtime changed - content is compared by hash.
+        stat = os.stat(self.filename)
+        os.utime(self.filename,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        manifest = Manifest(self.path)
+        self.assertTrue(
+            manifest.is_current(self.filename, None, self.options))
+        self.assertEqual(manifest.files['111loc']['mtime'],
+                         stat.st_mtime_ns + 10**9)
+
+    def test_stat(self):
+        stat = os.stat(self.filename)
+        self.assertFalse(Manifest(self.path).is_current(
+            self.filename, FileStat(stat.st_size + 1, stat.st_mtime_ns),
+            self.options))
+
+
+class RenderCacheTests(SimpleTestCase):
+    """Rendered images are reused and evicted least recently used first."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+        self.mapnik_xml = os.path.join(self.path, 'mapnik.xml')
+        with open(self.mapnik_xml, 'w') as f:
+            f.write('<Map/>')
+        self.cache = self.make_cache()
+
+    def make_cache(self, max_size=render.RENDER_CACHE_SIZE):
+        return render.RenderCache(os.path.join(self.path, 'cache'), max_size,
+                                  self.mapnik_xml)
+
+    def job(self, name, points=((4000000.4, 7500000.6),), content=None):
+        output = os.path.join(self.path, name)
+        if content is not None:
+            with open(output, 'w') as f:
+                f.write(content)
+        return render.RenderJob(list(points), output, 2000)
+
+    def test_fetch_stored(self):
+        job = self.job('1.png', content='image')
+        self.assertFalse(self.cache.fetch(job))
+        self.cache.store(job)
+        other = self.job('2.png')
+        self.assertTrue(self.cache.fetch(other))
+        with open(other.output) as f:
+            self.assertEqual(f.read(), 'image')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_rounded_points(self):
+        self.cache.store(self.job('1.png', content='image'))
+        self.assertTrue(self.cache.fetch(
+            self.job('2.png', points=((4000000.2, 7500000.9),))))
+        self.assertFalse(self.cache.fetch(
+            self.job('3.png', points=((4000002, 7500000),))))
+
+    def test_changed_stylesheet(self):
+        self.cache.store(self.job('1.png', content='image'))
+        with open(self.mapnik_xml, 'w') as f:
+            f.write('<Map srs="">')
+        self.assertFalse(self.make_cache().fetch(self.job('2.png')))
+
+    def test_evict(self):
+        cache = self.make_cache(max_size=10)
+        jobs = [self.job(f'{n}.png', points=((n * 10000, 0),),
+                         content='image')
+                for n in range(3)]
+        for mtime, job in enumerate(jobs):
+            cache.store(job)
+            os.utime(cache.path(job), (mtime, mtime))
+        # The oldest entry becomes recently used.
+        self.assertTrue(cache.fetch(jobs[0]))
+        cache.evict()
+        self.assertEqual([os.path.exists(cache.path(job)) for job in jobs],
+                         [True, False, True])
+
+
+class TaskQueueTests(TestCase):
+    """Workers take queued tasks once and queue again abandoned ones."""
+
+    def add_task(self, sz, minutes_ago):
+        task = Task.objects.create(year='2020', depart='1', sz=sz,
+                                   status=Task.STATUS_QUEUED)
+        added = timezone.now() - timedelta(minutes=minutes_ago)
+        Task.objects.filter(id=task.id).update(dateTime_added=added)
+        return task
+
+    def test_claim_next_oldest(self):
+        self.add_task('new', 1)
+        old = self.add_task('old', 2)
+        task = Task.claim_next()
+        self.assertEqual(task.id, old.id)
+        old.refresh_from_db()
+        self.assertEqual(old.status, Task.STATUS_PROCESSING)
+        self.assertIsNotNone(old.started_at)
+
+    def test_claim_next_once(self):
+        self.add_task('one', 1)
+        self.assertIsNotNone(Task.claim_next())
+        self.assertIsNone(Task.claim_next())
+
+    def test_claim_next_skips_other_statuses(self):
+        task = self.add_task('done', 1)
+        Task.objects.filter(id=task.id).update(status=Task.STATUS_DONE)
+        self.assertIsNone(Task.claim_next())
+
+    def test_reclaim_stale(self):
+        stale, fresh = self.add_task('stale', 2), self.add_task('fresh', 1)
+        Task.claim_next()
+        Task.claim_next()
+        Task.objects.filter(id=stale.id).update(
+            stage='render', updated_at=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(Task.reclaim_stale(60), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, stale.stage), (Task.STATUS_QUEUED, ''))
+        self.assertEqual(fresh.status, Task.STATUS_PROCESSING)
+        self.assertEqual(Task.claim_next().id, stale.id)
+
+    def test_requeue(self):
+        task = self.add_task('one', 1)
+        Task.claim_next()
+        Task.requeue(task.id)
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_QUEUED)
+        self.assertIsNone(task.started_at)
+        self.assertEqual(Task.claim_next().id, task.id)
+
+
+class CatalogTests(SimpleTestCase):
+    """Listings of directories are read again only when they changed."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        os.makedirs(os.path.join(self.root, '2020', '1', '111'))
+
+    def add_year(self, year):
+        """Create directory of year keeping mtime of root as it was."""
+        stat = os.stat(self.root)
+        os.mkdir(os.path.join(self.root, year))
+        return stat
+
+    def test_tree(self):
+        catalog = Catalog(self.root)
+        self.assertEqual(catalog.years(), ['2020'])
+        self.assertEqual(catalog.departments('2020'), ['1'])
+        self.assertEqual(catalog.sz('2020', '1'), ['111'])
+        self.assertEqual(catalog.departments('2019'), [])
+        self.assertEqual(catalog.sz('2020', '2'), [])
+
+    def test_ttl(self):
+        catalog = Catalog(self.root, ttl=3600)
+        catalog.years()
+        self.add_year('2021')
+        self.assertEqual(catalog.years(), ['2020'])
+
+    def test_changed_mtime(self):
+        catalog = Catalog(self.root, ttl=0)
+        catalog.years()
+        stat = self.add_year('2021')
+        os.utime(self.root, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(catalog.years(), ['2020', '2021'])
+
+    def test_same_mtime(self):
+        # TTL is over, but directory is not listed while mtime is the same.
+        catalog = Catalog(self.root, ttl=0)
+        catalog.years()
+        stat = self.add_year('2021')
+        os.utime(self.root, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(catalog.years(), ['2020'])
+
+
+class DiscoverTests(SimpleTestCase):
+    """Subscriber files are found in the whole directory tree."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+
+    def touch(self, *parts):
+        filename = os.path.join(self.path, *parts)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(parts[-1])
+        return filename
+
+    def test_nested(self):
+        loc = self.touch('111loc')
+        ext = self.touch('a', 'b', '111.ext1')
+        other = self.touch('a', '222.ext2')
+        self.touch('a', 'b', 'c', 'notes.txt')
+        os.makedirs(os.path.join(self.path, 'empty'))
+        index = discover(self.path, workers=2)
+        self.assertEqual(list(index), ['111', '222'])
+        self.assertEqual({kind: info.path for kind, info in
+                          index['111'].items()},
+                         {'loc': loc, '.ext1': ext})
+        self.assertEqual(index['222']['.ext2'],
+                         FileInfo(other, os.path.getsize(other),
+                                  os.stat(other).st_mtime_ns))
+
+    def test_duplicate(self):
+        # The first path in sort order is used whatever the order of scan.
+        first = self.touch('a', '111loc')
+        self.touch('b', 'c', '111loc')
+        self.touch('b', '111loc')
+        with self.assertLogs(level='WARNING'):
+            index = discover(self.path)
+        self.assertEqual(index['111']['loc'].path, first)
+
+
+class SpatialIndexTests(SimpleTestCase):
+    """Locations of files are searched by area and summed by cell site."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.index = SpatialIndex(os.path.join(tmp.name, 'locations.sqlite3'))
+        self.addCleanup(self.index.close)
+
+    def add(self, source, number, rows):
+        """Add file with rows (lat, lon, operator, countEvents)."""
+        df_loc = pd.DataFrame(
+            [{'countEvents': events, 'operator': operator, 'param2': 'A1',
+              'param3': '1ff', 'address': f"{lat}, {lon}", 'lat': 'N',
+              'latDD': lat, 'lon': 'E', 'lonDD': lon}
+             for lat, lon, operator, events in rows],
+            columns=procloc.LOC_COLUMNS)
+        return self.index.add_file(source, 'task', number, df_loc)
+
+    def top(self, **kwargs):
+        return [(site['lat'], site['count_events'], site['numbers'])
+                for site in self.index.top(**kwargs)]
+
+    def test_add(self):
+        self.assertEqual(self.add('111loc', '111', [(55.0, 37.0, 'x', 5),
+                                                    (55.1, 37.0, 'x', 3)]),
+                         2)
+        self.add('222loc', '222', [(55.1, 37.0, 'x', 4)])
+        self.assertEqual(self.top(), [(55.1, 7, ['111', '222']),
+                                      (55.0, 5, ['111'])])
+        self.assertEqual(self.index.top()[0]['subscribers'], 2)
+
+    def test_without_coordinates(self):
+        self.assertEqual(self.add('111loc', '111', [(55.0, 37.0, 'x', 5),
+                                                    (None, None, 'x', 3)]),
+                         1)
+        self.assertEqual(len(self.index.bbox(-90, -180, 90, 180)), 1)
+
+    def test_sites(self):
+        # Other operator at the same point is other site, missing
+        # operator is the same as empty one.
+        self.add('111loc', '111', [(55.0, 37.0, 'x', 5),
+                                   (55.0, 37.0, 'y', 1),
+                                   (55.0, 37.0, None, 2)])
+        self.add('222loc', '222', [(55.0, 37.0, '', 3)])
+        self.assertEqual(self.top(), [(55.0, 5, ['111']),
+                                      (55.0, 5, ['111', '222']),
+                                      (55.0, 1, ['111'])])
+
+    def test_replace(self):
+        self.add('111loc', '111', [(55.0, 37.0, 'x', 5),
+                                   (55.1, 37.0, 'x', 3)])
+        self.add('222loc', '222', [(55.1, 37.0, 'x', 4)])
+        self.add('111loc', '111', [(55.1, 37.0, 'x', 1),
+                                   (55.2, 37.0, 'x', 2)])
+        self.assertEqual(self.top(), [(55.1, 5, ['111', '222']),
+                                      (55.2, 2, ['111'])])
+        # Site without locations is removed from R-tree too.
+        self.assertEqual(self.index.bbox(54.9, 36.9, 55.05, 37.1), [])
+        self.assertEqual(self.top(box=(54.9, 36.9, 55.05, 37.1)), [])
+
+    def test_top(self):
+        self.add('111loc', '111', [(55.0 + n / 10, 37.0, 'x', n)
+                                   for n in range(1, 6)])
+        self.assertEqual([lat for lat, _, _ in self.top(count=2)],
+                         [55.5, 55.4])
+        self.assertEqual(self.top(count=2, box=(55.05, 36.9, 55.25, 37.1)),
+                         [(55.2, 2, ['111']), (55.1, 1, ['111'])])
+
+    def test_bbox(self):
+        self.add('111loc', '111', [(55.0, 37.0, 'x', 1),
+                                   (55.1, 37.0, 'x', 3),
+                                   (56.0, 37.0, 'x', 2)])
+        found = self.index.bbox(54.9, 36.9, 55.2, 37.1)
+        self.assertEqual([(row['lat'], row['number']) for row in found],
+                         [(55.1, '111'), (55.0, '111')])
+
+    def test_radius(self):
+        # 0.01 degree of latitude is about 1112 meters.
+        self.add('111loc', '111', [(55.02, 37.0, 'x', 1),
+                                   (55.0, 37.0, 'x', 1),
+                                   (55.01, 37.0, 'x', 1),
+                                   (55.0, 37.03, 'x', 1)])
+        found = self.index.radius(55.0, 37.0, 1500)
+        self.assertEqual([row['lat'] for row in found], [55.0, 55.01])
+        self.assertEqual(found[0]['distance'], 0)
+        self.assertAlmostEqual(found[1]['distance'], 1112, delta=1)
+        self.assertEqual(len(self.index.radius(55.0, 37.0, 2000)), 3)
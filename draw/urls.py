@@ -9,4 +9,12 @@ urlpatterns = [
     path('get_departs', views.get_departments, name='get_departs'),
     path('get_sz', views.get_sz, name='get_sz'),
     path('tasks/', views.tasks, name='tasks'),
+    path('tasks/progress', views.tasks_progress, name='tasks_progress'),
+    path('marker.png', views.marker_image, name='marker'),
+    path('metrics', views.metrics, name='metrics'),
+    path('locations/bbox', views.locations_bbox, name='locations_bbox'),
+    path('locations/radius', views.locations_radius, name='locations_radius'),
+    path('locations/top', views.locations_top, name='locations_top'),
+    path('tasks/<int:task_id>/metrics', views.task_metrics,
+         name='task_metrics'),
 ]
@@ -1,12 +1,37 @@
-from draw import procloc
 import os
+from datetime import timedelta
 
-from django.shortcuts import render, redirect, HttpResponseRedirect
-from django.http import JsonResponse
+from django.core.paginator import Paginator
+from django.shortcuts import (render, redirect, HttpResponseRedirect,
+                              get_object_or_404)
+from django.db.models import Count
+from django.http import (FileResponse, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified, JsonResponse)
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_datetime
+from draw import render as maprender
+from .catalog import catalog
 from .forms import TaskForm
-from .models import Task
+from .metrics import label, prometheus
+from .spatial import SPATIAL_DB, SpatialIndex
+from .models import MetricsTotal, Task
 
-PATH_TO_DIR = "/home/user/python_projects/"
+# Images of the same point never change, so browsers may keep them long.
+MARKER_MAX_AGE = 30 * 24 * 60 * 60
+
+TASKS_PER_PAGE = 50
+
+# Fields of task sent to page polling progress of tasks.
+PROGRESS_FIELDS = ('id', 'status', 'stage', 'files_done', 'files_total',
+                   'started_at', 'finished_at', 'updated_at', 'error')
+
+# Time of update of task is set before its row is committed, so tasks
+# updated this long before 'now' are sent again in the next poll.
+PROGRESS_OVERLAP = timedelta(seconds=5)
+
+# The most locations returned by one query of spatial index.
+LOCATIONS_LIMIT = 1000
 
 
 def index(request):
@@ -28,7 +53,7 @@ def index(request):
             taskObj.year = form.cleaned_data['yearField']
             taskObj.depart = form.cleaned_data['departField']
             taskObj.sz = form.cleaned_data['szField']
-            taskObj.status = "Добавленa в очередь на обработку"
+            taskObj.status = Task.STATUS_QUEUED
             taskObj.save()
             return redirect('draw:tasks')
 
@@ -40,11 +65,7 @@ def index(request):
 def get_departments(request):
     """Process the request for depart field."""
     year = request.GET.get('year')
-    fullPath = os.path.join(PATH_TO_DIR, year)
-    depart_list = [
-        item for item in os.listdir(fullPath)
-        if os.path.isdir(os.path.join(fullPath, item))
-    ]
+    depart_list = catalog.departments(year)
     # return JsonResponse({'data': depart_list})
     return render(request, 'draw/departs_dropdown_list_options.html',
                   {'departs': depart_list})
@@ -54,31 +75,150 @@ def get_sz(request):
     """Using ajax-request to load sz."""
     year = request.GET.get('year')
     depart = request.GET.get('depart')
-    fullPath = os.path.join(PATH_TO_DIR, year, depart)
-    sz_list = [
-        item for item in os.listdir(fullPath)
-        if os.path.isdir(os.path.join(fullPath, item))
-    ]
+    sz_list = catalog.sz(year, depart)
     return render(request, 'draw/sz_dropdown_list_options.html',
                   {'sz': sz_list})
 
 
 def tasks(request):
-    """Check the status of task, then if needed call the procloc functions
-    to process the bill files and render locations.
-    Show all tasks and it's status of proccessing."""
+    """Show all tasks and it's status of proccessing.
+    Tasks are processed by the process_tasks management command."""
 
     tasks = Task.objects.order_by('-dateTime_added')
-    if (tasks is not None):
-        for task in tasks:
-            if task.status == "Добавленa в очередь на обработку":
-                task.status = "Обрабатывается"
-                task.save()
-                path = os.path.join(PATH_TO_DIR, task.year, task.depart,
-                                    task.sz)
-                procloc.start(path)
-                task.status = "Завершена."
-                task.save()
-
-    context = {'tasks': tasks}
+    page = Paginator(tasks, TASKS_PER_PAGE).get_page(request.GET.get('page'))
+    context = {'tasks': page, 'page_obj': page}
     return render(request, 'draw/tasks.html', context)
+
+
+def tasks_progress(request):
+    """Progress of tasks changed after time in 'since' parameter in JSON.
+    Returned 'now' is used as 'since' in the next request, it is a bit
+    earlier than the current time, so the same task may come twice."""
+    now = timezone.now()
+    since = request.GET.get('since')
+    changed = Task.objects.filter(updated_at__lte=now)
+    if since:
+        since = parse_datetime(since)
+        if since is None:
+            return HttpResponseBadRequest("Wrong time in 'since'.")
+        changed = changed.filter(updated_at__gt=since)
+    else:
+        changed = changed.exclude(
+            status__in=[Task.STATUS_DONE, Task.STATUS_FAILED])
+    return JsonResponse({
+        'now': (now - PROGRESS_OVERLAP).isoformat(),
+        'tasks': list(changed.values(*PROGRESS_FIELDS)),
+    })
+
+
+def marker_image(request):
+    """Render on request map image with marker in point (x, y) in
+    EPSG 3857. Size of image and half of side of map box in meters
+    are taken from 'size' and 'half_size' parameters."""
+    try:
+        x = float(request.GET['x'])
+        y = float(request.GET['y'])
+        size = int(request.GET.get('size', maprender.MAP_SIZE))
+        half_size = int(request.GET.get('half_size', 2000))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Wrong coordinates of marker.")
+    bound = maprender.EPSG_3857_BOUND
+    if not (-bound <= x <= bound and -bound <= y <= bound):
+        return HttpResponseBadRequest("Coordinates are out of map.")
+    if size not in maprender.MARKER_SIZES or not 100 <= half_size <= 100000:
+        return HttpResponseBadRequest("Wrong size of image.")
+
+    # Name of cache entry is a hash of all parameters of image.
+    points = [(x, y)]
+    etag = '"' + os.path.basename(
+        maprender.cached_path(points, half_size, size)) + '"'
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponseNotModified()
+
+    entry = maprender.render_cached(points, half_size, size)
+    response = FileResponse(open(entry, 'rb'), content_type='image/png')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=MARKER_MAX_AGE)
+    return response
+
+
+def metrics(request):
+    """Metrics of processing of all tasks in Prometheus text format."""
+    lines = ['# TYPE procloc_tasks gauge']
+    for row in Task.objects.values('status').annotate(count=Count('id')):
+        lines.append(f'procloc_tasks{{status="{label(row["status"])}"}} '
+                     f'{row["count"]}')
+    # Totals are kept by workers, so tasks themselves are not read.
+    content = '\n'.join(lines) + '\n' + prometheus(MetricsTotal.current())
+    return HttpResponse(content, content_type='text/plain; version=0.0.4')
+
+
+def task_metrics(request, task_id):
+    """Aggregated metrics of processing of one task in JSON."""
+    task = get_object_or_404(Task, id=task_id)
+    return JsonResponse({
+        'id': task.id,
+        'status': task.status,
+        'duration': task.duration,
+        'files_processed': task.files_processed,
+        'files_failed': task.files_failed,
+        'metrics': task.metrics,
+    })
+
+
+def _floats(request, *names):
+    """Return float parameters <names> of request, None if some is wrong."""
+    try:
+        return [float(request.GET[name]) for name in names]
+    except (KeyError, ValueError):
+        return None
+
+
+def _limit(request, default=LOCATIONS_LIMIT):
+    try:
+        return max(1, min(int(request.GET.get('limit', default)),
+                          LOCATIONS_LIMIT))
+    except ValueError:
+        return default
+
+
+def locations_bbox(request):
+    """Locations of all processed files inside box in JSON."""
+    box = _floats(request, 'min_lat', 'min_lon', 'max_lat', 'max_lon')
+    if box is None:
+        return HttpResponseBadRequest("Wrong box.")
+    index = SpatialIndex(SPATIAL_DB)
+    try:
+        found = index.bbox(*box, limit=_limit(request))
+    finally:
+        index.close()
+    return JsonResponse({'locations': found})
+
+
+def locations_radius(request):
+    """Locations of all processed files near point (lat, lon) in JSON."""
+    circle = _floats(request, 'lat', 'lon', 'radius')
+    if circle is None:
+        return HttpResponseBadRequest("Wrong point or radius.")
+    index = SpatialIndex(SPATIAL_DB)
+    try:
+        found = index.radius(*circle, limit=_limit(request))
+    finally:
+        index.close()
+    return JsonResponse({'locations': found})
+
+
+def locations_top(request):
+    """Cell sites with most events and numbers seen there in JSON.
+    Sites are taken inside box if its parameters are set."""
+    box = None
+    if 'min_lat' in request.GET:
+        box = _floats(request, 'min_lat', 'min_lon', 'max_lat', 'max_lon')
+        if box is None:
+            return HttpResponseBadRequest("Wrong box.")
+    index = SpatialIndex(SPATIAL_DB)
+    try:
+        found = index.top(_limit(request, 10), box)
+    finally:
+        index.close()
+    return JsonResponse({'sites': found})